@@ -0,0 +1,485 @@
+"""Benchmark per-frame cost of Index Visualizer's rendering stages.
+
+Synthetic meshes (grids and subdivided icospheres) are generated and each
+stage of the View3D overlay (read, collect, project, layout, draw) and the
+UV Editor overlay (collect, layout, draw) is timed. Results are written as
+JSON, so that they can be compared between revisions.
+
+Run without Blender (Blender modules are replaced by bpy_stub):
+
+    python benchmarks/bench_index_visualizer.py --output results.json
+
+Run inside Blender (draw stages are skipped since there is no GL context):
+
+    blender --background --python benchmarks/bench_index_visualizer.py \\
+        -- --output results.json
+
+Compare with previous results and fail if any stage got slower:
+
+    python benchmarks/bench_index_visualizer.py --baseline results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+try:
+    import bpy
+    IN_BLENDER = hasattr(bpy, "data")
+except ImportError:
+    IN_BLENDER = False
+
+if not IN_BLENDER:
+    import bpy_stub
+    bpy_stub.install()
+    import bpy
+
+import ui_index_visualizer as iv
+
+
+# Synthetic meshes
+
+def build_mesh(co, loop_verts, loop_total, uv):
+    """Build MeshArrays and per loop UV from polygons."""
+    loop_start = np.zeros(len(loop_total), dtype=np.int32)
+    np.cumsum(loop_total[:-1], out=loop_start[1:])
+    loop_next = np.arange(1, len(loop_verts) + 1)
+    loop_next[loop_start + loop_total - 1] = loop_start
+
+    # edges are unique pairs of (loop vert, next loop vert)
+    pairs = np.sort(np.stack([loop_verts, loop_verts[loop_next]], axis=1),
+                    axis=1).astype(np.int64)
+    keys = pairs[:, 0] * len(co) + pairs[:, 1]
+    uniq, loop_edges = np.unique(keys, return_inverse=True)
+    edge_verts = np.stack([uniq // len(co), uniq % len(co)], axis=1)
+
+    arrays = iv.MeshArrays(
+        co=co.astype(np.float32),
+        vert_sel=np.ones(len(co), dtype=np.bool_),
+        edge_verts=edge_verts.astype(np.int32),
+        edge_sel=np.ones(len(edge_verts), dtype=np.bool_),
+        loop_verts=loop_verts.astype(np.int32),
+        loop_edges=loop_edges.astype(np.int32),
+        face_loop_start=loop_start,
+        face_loop_total=loop_total.astype(np.int32),
+        face_sel=np.ones(len(loop_total), dtype=np.bool_)
+    )
+    return (arrays, uv.astype(np.float32))
+
+
+def make_grid(n):
+    """Grid of n x n vertices with quads."""
+    x, y = np.meshgrid(np.linspace(-1.0, 1.0, n), np.linspace(-1.0, 1.0, n))
+    co = np.stack([x.ravel(), y.ravel(), np.zeros(n * n)], axis=1)
+    i, j = np.meshgrid(np.arange(n - 1), np.arange(n - 1), indexing='ij')
+    v = (i * n + j).ravel()
+    loop_verts = np.stack([v, v + 1, v + n + 1, v + n], axis=1).ravel()
+    loop_total = np.full(len(v), 4, dtype=np.int32)
+    uv = (co[loop_verts, :2] + 1.0) * 0.5
+    return build_mesh(co, loop_verts, loop_total, uv)
+
+
+def make_icosphere(subdivisions):
+    """Icosphere made by subdividing icosahedron."""
+    t = (1.0 + 5.0 ** 0.5) / 2.0
+    co = np.array([
+        (-1, t, 0), (1, t, 0), (-1, -t, 0), (1, -t, 0),
+        (0, -1, t), (0, 1, t), (0, -1, -t), (0, 1, -t),
+        (t, 0, -1), (t, 0, 1), (-t, 0, -1), (-t, 0, 1)], dtype=np.float64)
+    tris = np.array([
+        (0, 11, 5), (0, 5, 1), (0, 1, 7), (0, 7, 10), (0, 10, 11),
+        (1, 5, 9), (5, 11, 4), (11, 10, 2), (10, 7, 6), (7, 1, 8),
+        (3, 9, 4), (3, 4, 2), (3, 2, 6), (3, 6, 8), (3, 8, 9),
+        (4, 9, 5), (2, 4, 11), (6, 2, 10), (8, 6, 7), (9, 8, 1)])
+    co /= np.linalg.norm(co, axis=1)[:, np.newaxis]
+
+    for _ in range(subdivisions):
+        e = np.sort(np.concatenate([tris[:, [0, 1]], tris[:, [1, 2]],
+                                    tris[:, [2, 0]]]), axis=1)
+        keys = e[:, 0] * len(co) + e[:, 1]
+        uniq, inv = np.unique(keys, return_inverse=True)
+        mid = (co[uniq // len(co)] + co[uniq % len(co)]) * 0.5
+        mid /= np.linalg.norm(mid, axis=1)[:, np.newaxis]
+        m = inv.reshape(3, -1) + len(co)
+        a, b, c = tris[:, 0], tris[:, 1], tris[:, 2]
+        tris = np.concatenate([
+            np.stack([a, m[0], m[2]], axis=1),
+            np.stack([m[0], b, m[1]], axis=1),
+            np.stack([m[2], m[1], c], axis=1),
+            np.stack([m[0], m[1], m[2]], axis=1)])
+        co = np.concatenate([co, mid])
+
+    loop_verts = tris.ravel()
+    loop_total = np.full(len(tris), 3, dtype=np.int32)
+    lc = co[loop_verts]
+    uv = np.stack([np.arctan2(lc[:, 1], lc[:, 0]) / (2 * np.pi) + 0.5,
+                   np.arcsin(np.clip(lc[:, 2], -1.0, 1.0)) / np.pi + 0.5],
+                  axis=1)
+    return build_mesh(co, loop_verts, loop_total, uv)
+
+
+MESHES = [
+    ("grid", 32, make_grid),
+    ("grid", 100, make_grid),
+    ("grid", 317, make_grid),
+    ("grid", 1000, make_grid),
+    ("icosphere", 3, make_icosphere),
+    ("icosphere", 5, make_icosphere),
+    ("icosphere", 7, make_icosphere),
+    ("icosphere", 8, make_icosphere),
+]
+
+
+# Stand-ins of Blender data
+
+class FakeCollection:
+    """Collection supporting foreach_get like bpy_prop_collection."""
+
+    def __init__(self, **attrs):
+        self.__attrs = attrs
+        self.__len = len(next(iter(attrs.values())))
+
+    def __len__(self):
+        return self.__len
+
+    def foreach_get(self, attr, buf):
+        buf[:] = self.__attrs[attr].ravel()
+
+
+def make_fake_object(arrays, uv):
+    me = SimpleNamespace(
+        vertices=FakeCollection(co=arrays.co, select=arrays.vert_sel),
+        edges=FakeCollection(vertices=arrays.edge_verts,
+                             select=arrays.edge_sel),
+        loops=FakeCollection(vertex_index=arrays.loop_verts,
+                             edge_index=arrays.loop_edges),
+        polygons=FakeCollection(loop_start=arrays.face_loop_start,
+                                loop_total=arrays.face_loop_total,
+                                select=arrays.face_sel),
+        uv_layers=SimpleNamespace(active=SimpleNamespace(
+            data=FakeCollection(uv=uv, select=np.ones(len(uv), np.bool_)))))
+    return SimpleNamespace(data=me, matrix_world=np.eye(4),
+                           update_from_editmode=lambda: True)
+
+
+def make_real_object(name, arrays, uv):
+    """Create mesh object in edit mode from arrays (Blender only)."""
+    import bmesh
+    me = bpy.data.meshes.new(name)
+    me.vertices.add(len(arrays.co))
+    me.vertices.foreach_set("co", arrays.co.ravel())
+    me.loops.add(len(arrays.loop_verts))
+    me.loops.foreach_set("vertex_index", arrays.loop_verts)
+    me.polygons.add(len(arrays.face_loop_total))
+    me.polygons.foreach_set("loop_start", arrays.face_loop_start)
+    me.polygons.foreach_set("loop_total", arrays.face_loop_total)
+    me.update(calc_edges=True)
+    me.uv_textures.new()
+    me.uv_layers.active.data.foreach_set("uv", uv.ravel())
+    for seq in (me.vertices, me.edges, me.polygons):
+        seq.foreach_set("select", np.ones(len(seq), dtype=np.bool_))
+
+    scene = bpy.context.scene
+    obj = bpy.data.objects.new(name, me)
+    scene.objects.link(obj)
+    scene.objects.active = obj
+    bpy.ops.object.mode_set(mode='EDIT')
+    return (obj, bmesh.from_edit_mesh(me))
+
+
+def remove_real_object(obj):
+    me = obj.data
+    bpy.ops.object.mode_set(mode='OBJECT')
+    bpy.context.scene.objects.unlink(obj)
+    bpy.data.objects.remove(obj)
+    bpy.data.meshes.remove(me)
+
+
+def make_view(width, height):
+    """View looking at the origin from (0, -3, 2) with 50 degree FOV."""
+    eye = np.array([0.0, -3.0, 2.0])
+    f = -eye / np.linalg.norm(eye)
+    r = np.cross(f, [0.0, 0.0, 1.0])
+    r /= np.linalg.norm(r)
+    u = np.cross(r, f)
+    view = np.eye(4)
+    view[0, :3], view[1, :3], view[2, :3] = r, u, -f
+    view[:3, 3] = -np.dot(view[:3, :3], eye)
+
+    near, far = 0.1, 100.0
+    fy = 1.0 / np.tan(np.radians(50.0) / 2.0)
+    proj = np.zeros((4, 4))
+    proj[0, 0] = fy * height / width
+    proj[1, 1] = fy
+    proj[2, 2] = (far + near) / (near - far)
+    proj[2, 3] = 2.0 * far * near / (near - far)
+    proj[3, 2] = -1.0
+
+    return iv.ViewParams(width=width, height=height,
+                         perspective_matrix=np.dot(proj, view),
+                         view_matrix=view, is_perspective=True)
+
+
+def make_context(select_sync=False):
+    scene = SimpleNamespace(
+        iv_font_size=13,
+        iv_box_color=(0.0, 0.0, 0.0, 1.0),
+        iv_text_color=(1.0, 1.0, 1.0, 1.0),
+        iv_max_labels=2000,
+        iv_hide_overlapped=True,
+        iv_visible_only=False,
+        iv_use_worker=False,
+        iv_lod=False,
+        iv_near_cursor=False,
+        iv_adaptive=False,
+        iv_nav_labels=200,
+        iv_settle_time=0.2,
+        iv_cache_layer=False,
+        iv_progressive=False,
+        iv_time_budget=4.0,
+        iv_all_kinds=False,
+        ruvi_properties=SimpleNamespace(verts=True, edges=True, faces=True,
+                                        loops=True, font_size=11),
+        tool_settings=SimpleNamespace(use_uv_select_sync=select_sync))
+    return SimpleNamespace(scene=scene)
+
+
+class FakeView2D:
+    """View2D showing UV (0, 0)-(1, 1) in 1000x1000 region, or its
+    bottom left part zoomed in by zoom."""
+
+    def __init__(self, zoom=1.0):
+        self.zoom = zoom
+
+    def view_to_region(self, x, y, clip=True):
+        return (int(x * 1000 * self.zoom), int(y * 1000 * self.zoom))
+
+
+# Benchmark
+
+def measure(func, repeat):
+    """Return (result, list of elapsed seconds)."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return (result, times)
+
+
+def record(results, suite, mesh, size, elements, stage, times, **extra):
+    r = {
+        "suite": suite,
+        "mesh": mesh,
+        "size": size,
+        "elements": elements,
+        "stage": stage,
+        "min_ms": min(times) * 1000.0,
+        "median_ms": statistics.median(times) * 1000.0,
+    }
+    r.update(extra)
+    results.append(r)
+    print("{suite:7s} {mesh:9s} {size:5d} {elements:8d} {stage:8s} "
+          "{median_ms:10.3f} ms".format(**r))
+
+
+def count_draw_calls(func):
+    if IN_BLENDER:
+        return None
+    bpy_stub.calls.clear()
+    func()
+    return dict(bpy_stub.calls)
+
+
+def prepare_views(snapshot, views, settings):
+    """Prepare labels of new snapshot for views as regions of one frame."""
+    cache = iv.SnapshotCache()
+    cache.update(None, snapshot)
+    sources = [(cache.version, snapshot)]
+    return [iv.IVRenderer.prepare(sources, view, settings,
+                                  cache=iv.RegionCache())
+            for view in views]
+
+
+def bench_view3d(results, name, size, arrays, uv, obj, bm, repeat):
+    context = make_context()
+    settings = iv.IVRenderer.get_frame_settings(context)
+    view = make_view(1920, 1080)
+
+    for mode in ("VERT", "EDGE", "FACE"):
+        elements = {"VERT": len(arrays.co),
+                    "EDGE": len(arrays.edge_verts),
+                    "FACE": len(arrays.face_loop_total)}[mode]
+        if obj is None:
+            fake = make_fake_object(arrays, uv)
+            _, times = measure(lambda: iv.read_mesh_arrays(fake, None),
+                               repeat)
+            snapshot = iv.MeshSnapshot(arrays, frozenset([mode]), np.eye(4))
+        else:
+            bm.select_mode = {mode}
+            snapshot, times = measure(lambda: iv.IVRenderer.read(obj, bm),
+                                      repeat)
+        suite = "view3d_" + mode.lower()
+        record(results, suite, name, size, elements, "read", times)
+
+        collected, times = measure(lambda: iv.IVRenderer.collect(snapshot),
+                                   repeat)
+        record(results, suite, name, size, elements, "collect", times,
+               labels=len(collected.indices))
+
+        projected, times = measure(
+            lambda: iv.IVRenderer.project(view, collected), repeat)
+        record(results, suite, name, size, elements, "project", times,
+               labels=len(projected.indices))
+
+        layout, times = measure(
+            lambda: iv.IVRenderer.layout(settings, view, projected), repeat)
+        record(results, suite, name, size, elements, "layout", times,
+               labels=len(layout.indices))
+
+        # regions of quad view share collected labels
+        for stage, n in (("prepare", 1), ("prepare_quad", 4)):
+            layouts, times = measure(
+                lambda: prepare_views(snapshot, [view] * n, settings),
+                repeat)
+            record(results, suite, name, size, elements, stage, times,
+                   labels=sum(len(l.indices) for l in layouts))
+
+        if not IN_BLENDER:
+            _, times = measure(lambda: iv.IVRenderer.draw(settings, layout),
+                               repeat)
+            record(results, suite, name, size, elements, "draw", times,
+                   labels=len(layout.indices),
+                   calls=count_draw_calls(
+                       lambda: iv.IVRenderer.draw(settings, layout)))
+
+
+def bench_uv(results, name, size, arrays, uv, obj, bm, repeat):
+    context = make_context()
+    region = SimpleNamespace(view2d=FakeView2D(), width=1000, height=1000)
+    zoomed = SimpleNamespace(view2d=FakeView2D(8.0), width=1000, height=1000)
+    if obj is None:
+        obj = make_fake_object(arrays, uv)
+        uv_layer = None
+    else:
+        uv_layer = bm.loops.layers.uv.verify()
+    elements = len(arrays.loop_verts)
+
+    data, times = measure(
+        lambda: iv.RenderUVIndex.collect(context, obj, bm, uv_layer), repeat)
+    record(results, "uv", name, size, elements, "collect", times,
+           labels=len(data.labels))
+
+    # zoomed in view shows 1/64 of UV
+    culled, times = measure(
+        lambda: iv.RenderUVIndex.cull(context, zoomed, data), repeat)
+    record(results, "uv", name, size, elements, "cull_zoomed", times,
+           labels=len(culled))
+
+    culled = iv.RenderUVIndex.cull(context, region, data)
+    labels, times = measure(
+        lambda: iv.RenderUVIndex.dedup(region, culled), repeat)
+    record(results, "uv", name, size, elements, "dedup", times,
+           labels=len(labels))
+
+    layout, times = measure(
+        lambda: iv.RenderUVIndex.layout(context, region, labels), repeat)
+    record(results, "uv", name, size, elements, "layout", times,
+           labels=len(layout.indices))
+
+    if not IN_BLENDER:
+        _, times = measure(lambda: iv.RenderUVIndex.draw(context, layout),
+                           repeat)
+        record(results, "uv", name, size, elements, "draw", times,
+               labels=len(layout.indices),
+               calls=count_draw_calls(
+                   lambda: iv.RenderUVIndex.draw(context, layout)))
+
+
+def compare(results, baseline_path, threshold):
+    """Return list of stages slower than baseline * threshold."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    key = lambda r: (r["suite"], r["mesh"], r["size"], r["stage"])
+    base = {key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get(key(r))
+        if b is not None and r["median_ms"] > b["median_ms"] * threshold:
+            regressions.append((key(r), b["median_ms"], r["median_ms"]))
+    return regressions
+
+
+def parse_args():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv \
+        else sys.argv[1:]
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="JSON file to write results")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-elements", type=int, default=1100000,
+                        help="skip meshes with more vertices than this")
+    parser.add_argument("--suite", choices=["all", "view3d", "uv"],
+                        default="all")
+    parser.add_argument("--baseline", help="JSON file of previous results")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="allowed slowdown ratio against baseline")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    results = []
+    for name, size, factory in MESHES:
+        arrays, uv = factory(size)
+        if len(arrays.co) > args.max_elements:
+            continue
+        obj = bm = None
+        if IN_BLENDER:
+            obj, bm = make_real_object("iv_bench", arrays, uv)
+        try:
+            if args.suite in ("all", "view3d"):
+                bench_view3d(results, name, size, arrays, uv, obj, bm,
+                             args.repeat)
+            if args.suite in ("all", "uv"):
+                bench_uv(results, name, size, arrays, uv, obj, bm,
+                         args.repeat)
+        finally:
+            if obj is not None:
+                remove_real_object(obj)
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "blender": bpy.app.version_string if IN_BLENDER else None,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold)
+        for key, before, after in regressions:
+            print("REGRESSION {}: {:.3f} ms -> {:.3f} ms".format(
+                "/".join(str(k) for k in key), before, after))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
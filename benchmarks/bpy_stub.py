@@ -0,0 +1,191 @@
+"""Lightweight stand-in of the Blender modules used by ui_index_visualizer.
+
+Only what is needed to import the add-on and to run its rendering stages
+outside of Blender is provided. Functions of bgl and blf do nothing but
+count how many times they are called, so that draw submission can be
+measured on a machine without GPU.
+"""
+
+import sys
+import types
+from collections import Counter
+
+calls = Counter()
+
+
+class _CountingModule(types.ModuleType):
+    """Module whose unknown functions are no-op and counted.
+    Upper case attributes are treated as constants."""
+
+    def __init__(self, name, functions=None):
+        super().__init__(name)
+        self.__functions = functions or {}
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if name.isupper() or name.startswith("GL_"):
+            value = sum(ord(c) for c in name)
+            setattr(self, name, value)
+            return value
+
+        qualified = "{}.{}".format(self.__name__, name)
+        impl = self.__functions.get(name)
+
+        def func(*args, **kwargs):
+            calls[qualified] += 1
+            if impl is not None:
+                return impl(*args, **kwargs)
+            return None
+
+        setattr(self, name, func)
+        return func
+
+
+class Buffer:
+    def __init__(self, type_, dimensions, template=None):
+        calls["bgl.Buffer"] += 1
+        if template is None:
+            template = [0] * dimensions
+        if isinstance(template, memoryview) or \
+                hasattr(template, "__array_interface__"):
+            # objects with buffer protocol are copied at once
+            self.__data = bytearray(memoryview(template).cast("B"))
+        else:
+            self.__data = list(template)
+
+    def __getitem__(self, i):
+        return self.__data[i]
+
+    def __setitem__(self, i, v):
+        self.__data[i] = v
+
+    def __len__(self):
+        return len(self.__data)
+
+
+class _BlfState:
+    size = 11
+
+
+def _blf_size(fontid, size, dpi=72):
+    _BlfState.size = size
+
+
+def _blf_dimensions(fontid, text):
+    return (len(text) * _BlfState.size * 0.55, _BlfState.size * 0.75)
+
+
+def _gl_create(*args):
+    return 1
+
+
+def _gl_get_status(obj, pname, status):
+    # shaders and programs always compile and link
+    status[0] = 1
+
+
+class _OffScreen:
+    color_texture = 0
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def bind(self):
+        calls["gpu.offscreen.bind"] += 1
+
+    def unbind(self):
+        calls["gpu.offscreen.unbind"] += 1
+
+    def free(self):
+        pass
+
+
+class _Base:
+    pass
+
+
+class _Space:
+    @staticmethod
+    def draw_handler_add(*args):
+        return object()
+
+    @staticmethod
+    def draw_handler_remove(*args):
+        pass
+
+
+class Vector(tuple):
+    def __new__(cls, seq):
+        return super().__new__(cls, (float(v) for v in seq))
+
+
+class BVHTree:
+    @classmethod
+    def FromBMesh(cls, bm):
+        raise NotImplementedError("BVHTree is not available in bpy_stub")
+
+
+def _prop(*args, **kwargs):
+    return None
+
+
+def install():
+    """Register stand-in modules to sys.modules."""
+    bpy = types.ModuleType("bpy")
+    bpy.types = types.ModuleType("bpy.types")
+    bpy.types.Operator = _Base
+    bpy.types.Panel = _Base
+    bpy.types.PropertyGroup = _Base
+    bpy.types.Scene = _Base
+    bpy.types.SpaceView3D = _Space
+    bpy.types.SpaceImageEditor = _Space
+    bpy.props = types.ModuleType("bpy.props")
+    for name in ("BoolProperty", "IntProperty", "FloatProperty",
+                 "FloatVectorProperty", "EnumProperty", "StringProperty",
+                 "PointerProperty"):
+        setattr(bpy.props, name, _prop)
+    bpy.props.__all__ = [n for n in dir(bpy.props) if n.endswith("Property")]
+    bpy.app = types.SimpleNamespace(
+        handlers=types.SimpleNamespace(scene_update_post=[]),
+        version=None,
+        background=True
+    )
+    bpy.utils = types.SimpleNamespace(register_module=_prop,
+                                      unregister_module=_prop)
+    bpy.context = None
+
+    bgl = _CountingModule("bgl", {"glCreateProgram": _gl_create,
+                                  "glCreateShader": _gl_create,
+                                  "glGetShaderiv": _gl_get_status,
+                                  "glGetProgramiv": _gl_get_status})
+    bgl.Buffer = Buffer
+    blf = _CountingModule("blf", {"size": _blf_size,
+                                  "dimensions": _blf_dimensions})
+
+    gpu = types.ModuleType("gpu")
+    gpu.offscreen = types.SimpleNamespace(new=_OffScreen)
+
+    bmesh = types.ModuleType("bmesh")
+
+    def from_edit_mesh(me):
+        raise NotImplementedError("bmesh is not available in bpy_stub")
+    bmesh.from_edit_mesh = from_edit_mesh
+
+    mathutils = types.ModuleType("mathutils")
+    mathutils.Vector = Vector
+    mathutils.bvhtree = types.ModuleType("mathutils.bvhtree")
+    mathutils.bvhtree.BVHTree = BVHTree
+
+    sys.modules.update({
+        "bpy": bpy,
+        "bpy.types": bpy.types,
+        "bpy.props": bpy.props,
+        "bgl": bgl,
+        "blf": blf,
+        "bmesh": bmesh,
+        "gpu": gpu,
+        "mathutils": mathutils,
+        "mathutils.bvhtree": mathutils.bvhtree,
+    })
@@ -0,0 +1,212 @@
+"""Regression tests of Index Visualizer's rendering stages.
+
+Outputs of the vectorized stages are compared with straightforward
+per-element implementations. Blender modules are replaced by bpy_stub, so
+the tests run without Blender:
+
+    python benchmarks/test_index_visualizer.py
+"""
+
+import math
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+sys.path.insert(0, TEST_DIR)
+
+import bpy_stub
+bpy_stub.install()
+
+import ui_index_visualizer as iv
+import bench_index_visualizer as bench
+
+
+def angle_signed(v1, v2):
+    """Vector.angle_signed of mathutils."""
+    return math.atan2(v1[1] * v2[0] - v1[0] * v2[1],
+                      v1[0] * v2[0] + v1[1] * v2[1])
+
+
+class TestPlaceUVLabels(unittest.TestCase):
+
+    def test_same_as_per_loop_placement(self):
+        """place_uv_labels places labels as the per-loop placement which
+        it replaced."""
+        angles = np.radians(np.arange(0.0, 360.0, 7.5))
+        tangents = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+        tangents = np.concatenate([tangents, [[1.0, 0.0], [1.0, -1.0],
+                                              [-1.0, 1.0]]])
+        tangents /= np.linalg.norm(tangents, axis=1)[:, np.newaxis]
+        normals = tangents[:, ::-1] * (-1.0, 1.0)
+        n = len(tangents)
+        positions = np.random.RandomState(0).rand(n, 2) * 100.0
+        widths = np.full(n, 21.0)
+        heights = np.full(n, 8.0)
+        sub_offsets = np.where(np.arange(n) % 2 == 0, 0.0, 1.5)
+
+        origins, result = iv.place_uv_labels(positions, tangents, normals,
+                                             widths, heights, sub_offsets)
+        for i in range(n):
+            t, nor, v = tangents[i], normals[i], positions[i]
+            offset = (widths[i] * t + heights[i] * nor) / 2
+            sub_offset = sub_offsets[i] * heights[i] * nor
+            angle = angle_signed(t, (1, 0))
+            if angle_signed(t, (1, -1)) > 0:
+                v = v - offset + sub_offset
+            else:
+                v = v + offset + sub_offset
+                angle -= math.pi
+            np.testing.assert_allclose(origins[i], v, atol=1e-4)
+            self.assertAlmostEqual(result[i], angle, places=4)
+
+
+
+def layout_greedy(rects, width, height, max_labels, priority=None,
+                  accept=None, accepted_rects=()):
+    """Label layout testing each label against all accepted ones."""
+    inside = (rects[:, 2] >= 0) & (rects[:, 0] < width) & \
+             (rects[:, 3] >= 0) & (rects[:, 1] < height)
+    candidates = np.flatnonzero(inside)
+    if priority is not None:
+        candidates = candidates[np.argsort(priority[candidates],
+                                           kind='mergesort')]
+    accepted = []
+    others = list(accepted_rects)
+    for i in candidates.tolist():
+        x0, y0, x1, y1 = rects[i].tolist()
+        if any(x0 < ox1 and ox0 < x1 and y0 < oy1 and oy0 < y1
+               for (ox0, oy0, ox1, oy1) in others):
+            continue
+        if (accept is not None) and (not accept(i)):
+            continue
+        accepted.append(i)
+        others.append((x0, y0, x1, y1))
+        if len(accepted) >= max_labels:
+            break
+    return accepted
+
+
+class TestGlyphAtlas(unittest.TestCase):
+
+    def test_rotated_quads(self):
+        """Glyph quads of rotated labels are the ones of unrotated labels
+        rotated around text origins."""
+        atlas = iv.GlyphAtlas()
+        self.assertTrue(atlas.ensure(11))
+        rng = np.random.RandomState(4)
+        indices = rng.randint(0, 100000, 50)
+        origins = rng.rand(50, 2) * 500.0
+        angles = rng.rand(50) * 2.0 * np.pi
+
+        verts, uvs = atlas.get_glyph_quads(indices, origins)
+        rotated, rotated_uvs = atlas.get_glyph_quads(indices, origins,
+                                                     angles=angles)
+        _, label = atlas.get_glyph_codes(indices)
+        label = np.repeat(label, 4)
+        local = verts - origins[label]
+        cos = np.cos(angles[label])
+        sin = np.sin(angles[label])
+        expected = origins[label] + np.stack(
+            [cos * local[:, 0] - sin * local[:, 1],
+             sin * local[:, 0] + cos * local[:, 1]], axis=1)
+        np.testing.assert_allclose(rotated, expected, atol=1e-3)
+        np.testing.assert_array_equal(rotated_uvs, uvs)
+
+
+class TestLayoutLabels(unittest.TestCase):
+
+    def make_layout(self, rng, uniform):
+        n = rng.randint(1, 1000)
+        width, height = rng.randint(50, 800, 2)
+        x = rng.randint(-60, width + 60, n)
+        y = rng.randint(-30, height + 30, n)
+        if uniform:
+            w = np.full(n, rng.randint(1, 40))
+            h = np.full(n, rng.randint(1, 15))
+        else:
+            w = rng.randint(1, 60, n)
+            h = rng.randint(1, 20, n)
+        rects = np.stack([x, y, x + w, y + h], axis=1).astype(np.int32)
+        return (rects, width, height)
+
+    def test_same_as_greedy(self):
+        """layout_labels accepts the same labels as greedy layout."""
+        rng = np.random.RandomState(1)
+        for t in range(200):
+            rects, width, height = self.make_layout(rng, t % 3 == 0)
+            priority = rng.rand(len(rects)) if t % 2 else None
+            max_labels = rng.randint(1, 1000)
+            result = iv.layout_labels(rects, width, height, max_labels,
+                                      priority=priority)
+            expected = layout_greedy(rects, width, height, max_labels,
+                                     priority)
+            self.assertEqual(result.tolist(), expected)
+
+    def test_same_as_greedy_with_accept(self):
+        """Labels rejected by accept do not hide others."""
+        rng = np.random.RandomState(2)
+        for t in range(50):
+            rects, width, height = self.make_layout(rng, t % 3 == 0)
+            rejected = rng.rand(len(rects)) < 0.5
+            accept = lambda i: not rejected[i]
+            result = iv.layout_labels(rects, width, height, 1000,
+                                      accept=accept)
+            expected = layout_greedy(rects, width, height, 1000,
+                                     accept=accept)
+            self.assertEqual(result.tolist(), expected)
+
+    def test_same_as_greedy_with_shared_grid(self):
+        """Labels accepted in former calls with the grid are kept."""
+        rng = np.random.RandomState(3)
+        for t in range(50):
+            rects, width, height = self.make_layout(rng, t % 3 == 0)
+            half = len(rects) // 2
+            grid = iv.CoverageMap()
+            first = iv.layout_labels(rects[:half], width, height, 1000,
+                                     grid=grid)
+            second = iv.layout_labels(rects[half:], width, height, 1000,
+                                      grid=grid)
+            expected = layout_greedy(rects[:half], width, height, 1000)
+            self.assertEqual(first.tolist(), expected)
+            expected = layout_greedy(
+                rects[half:], width, height, 1000,
+                accepted_rects=rects[first].tolist())
+            self.assertEqual(second.tolist(), expected)
+
+
+
+class TestNearCursor(unittest.TestCase):
+
+    def test_grid_reused_when_selection_changed(self):
+        """Grid of elements is not built again when only selection is
+        changed."""
+        arrays, _ = bench.make_grid(20)
+        settings = iv.IVRenderer.get_frame_settings(bench.make_context())
+        settings = settings._replace(
+            near=iv.NearQuery('CURSOR', (0.0, 0.0, 0.0), 0.5))
+        view = bench.make_view(640, 480)
+
+        built = []
+        init = iv.ElementGrid.__init__
+
+        def count_init(grid, snapshot, kind):
+            built.append(kind)
+            init(grid, snapshot, kind)
+
+        with mock.patch.object(iv.ElementGrid, "__init__", count_init):
+            for selected in (arrays.vert_sel, ~arrays.vert_sel):
+                snapshot = iv.MeshSnapshot(
+                    arrays._replace(vert_sel=selected), frozenset(['VERT']),
+                    np.eye(4))
+                layout, = bench.prepare_views(snapshot, [view], settings)
+                self.assertGreater(len(layout.indices), 0)
+        self.assertEqual(built, [iv.LABEL_VERT])
+
+
+if __name__ == "__main__":
+    unittest.main()
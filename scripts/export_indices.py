@@ -0,0 +1,268 @@
+"""Export index -> position tables of mesh elements without UI.
+
+For each mesh object, indices and positions of vertices, edge midpoints,
+face centroids and, if the mesh has UV, UV verts/edges/loops/faces (placed
+per loop as in UV Editor) are written. Positions are collected by the same
+functions as Index Visualizer's overlays.
+
+Export .blend files with 4 Blender processes:
+
+    blender --background --python scripts/export_indices.py -- \\
+        --jobs 4 --output out/ a.blend b.blend ...
+
+Export the file opened in Blender:
+
+    blender --background a.blend --python scripts/export_indices.py -- \\
+        --output out/
+
+Tables are written as CSV (file,object,domain,index,x,y,z) quoted by csv
+module, or as binary (--format bin) consisting of "IVX1" magic followed
+by chunks. A chunk is a little-endian uint32 length of JSON header
+{object, domain, count, dim} followed by int32 indices and float32
+positions of count elements. Both formats are written in chunks of at
+most --chunk-size elements, so memory does not grow with the number of
+objects or files.
+"""
+
+import argparse
+import csv
+import json
+import os
+import struct
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+
+import bpy
+
+import ui_index_visualizer as iv
+
+MAGIC = b"IVX1"
+MESH_DOMAINS = (("vert", iv.LABEL_VERT), ("edge", iv.LABEL_EDGE),
+                ("face", iv.LABEL_FACE))
+UV_DOMAINS = (("uv_vert", iv.LABEL_VERT), ("uv_edge", iv.LABEL_EDGE),
+              ("uv_loop", iv.LABEL_LOOP), ("uv_face", iv.LABEL_FACE))
+
+
+def iter_tables(obj, world=True, uv=True):
+    """Yield (domain, indices, positions) tables of mesh object."""
+    arrays = iv.read_mesh_arrays(obj, None)
+    for domain, kind in MESH_DOMAINS:
+        positions = iv.get_element_positions(arrays, kind)
+        if world:
+            positions = iv.transform_points(obj.matrix_world, positions)
+        yield (domain, np.arange(len(positions)), positions)
+
+    if not uv or obj.data.uv_layers.active is None:
+        return
+    uv_co, _ = iv.read_uv_arrays(obj, None, None)
+    for domain, kind in UV_DOMAINS:
+        indices, positions = iv.get_uv_element_positions(arrays, uv_co, kind)
+        yield (domain, indices, positions)
+
+
+class CSVWriter:
+    def __init__(self, filepath, source):
+        self.__file = open(filepath, "w", newline="", encoding="utf-8")
+        self.__writer = csv.writer(self.__file, lineterminator="\n")
+        self.__source = source
+        self.__writer.writerow(("file", "object", "domain", "index",
+                                "x", "y", "z"))
+
+    def write(self, obj_name, domain, indices, positions):
+        # file and object names may contain commas or quotes, so fields are
+        # quoted by csv module, while numbers are formatted as before
+        prefix = (self.__source, obj_name, domain)
+        fmt = "{:.6g}".format
+        if positions.shape[1] == 2:
+            rows = (prefix + (i, fmt(x), fmt(y), "")
+                    for i, (x, y) in zip(indices.tolist(),
+                                         positions.tolist()))
+        else:
+            rows = (prefix + (i, fmt(x), fmt(y), fmt(z))
+                    for i, (x, y, z) in zip(indices.tolist(),
+                                            positions.tolist()))
+        self.__writer.writerows(rows)
+
+    def close(self):
+        self.__file.close()
+
+
+class BinaryWriter:
+    def __init__(self, filepath, source):
+        self.__file = open(filepath, "wb")
+        self.__file.write(MAGIC)
+
+    def write(self, obj_name, domain, indices, positions):
+        header = json.dumps({
+            "object": obj_name,
+            "domain": domain,
+            "count": len(indices),
+            "dim": positions.shape[1],
+        }).encode("utf-8")
+        self.__file.write(struct.pack("<I", len(header)))
+        self.__file.write(header)
+        self.__file.write(np.ascontiguousarray(indices, "<i4").tobytes())
+        self.__file.write(np.ascontiguousarray(positions, "<f4").tobytes())
+
+    def close(self):
+        self.__file.close()
+
+
+WRITERS = {"csv": (CSVWriter, ".csv"), "bin": (BinaryWriter, ".ivx")}
+
+
+def read_binary(filepath):
+    """Yield (header, indices, positions) chunks of binary output."""
+    with open(filepath, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not index table".format(filepath))
+        while True:
+            size = f.read(4)
+            if not size:
+                return
+            header = json.loads(
+                f.read(struct.unpack("<I", size)[0]).decode("utf-8"))
+            n = header["count"]
+            indices = np.frombuffer(f.read(n * 4), dtype="<i4")
+            positions = np.frombuffer(f.read(n * 4 * header["dim"]),
+                                      dtype="<f4").reshape(n, header["dim"])
+            yield (header, indices, positions)
+
+
+def get_objects(names=None, shard=0, shards=1):
+    objects = sorted((o for o in bpy.data.objects if o.type == 'MESH'),
+                     key=lambda o: o.name)
+    if names:
+        objects = [o for o in objects if o.name in names]
+    return objects[shard::shards]
+
+
+def export_current(filepath, args, shard=0, shards=1):
+    """Export mesh objects of the opened .blend file."""
+    source = os.path.basename(bpy.data.filepath)
+    writer_class, _ = WRITERS[args.format]
+    writer = writer_class(filepath, source)
+    try:
+        for obj in get_objects(args.objects, shard, shards):
+            for domain, indices, positions in iter_tables(
+                    obj, not args.local, not args.no_uv):
+                for i in range(0, len(indices), args.chunk_size):
+                    writer.write(obj.name, domain,
+                                 indices[i:i + args.chunk_size],
+                                 positions[i:i + args.chunk_size])
+    finally:
+        writer.close()
+
+
+def get_output_names(blends):
+    """Get output names of .blend files. Files of the same name in other
+    directories are numbered, so that they do not overwrite each other."""
+    names = {}
+    used = set()
+    for blend in blends:
+        base = os.path.splitext(os.path.basename(blend))[0]
+        name = base
+        n = 1
+        while name in used:
+            name = "{}_{}".format(base, n)
+            n += 1
+        used.add(name)
+        names[blend] = name
+    return names
+
+
+def get_output_path(args, name, shard, shards):
+    _, ext = WRITERS[args.format]
+    if shards > 1:
+        name += ".{}".format(shard)
+    return os.path.join(args.output, name + ext)
+
+
+def run_worker(args, blend, name, shard, shards):
+    """Export .blend file in new Blender process."""
+    # without --python-exit-code, script errors exit with 0
+    cmd = [bpy.app.binary_path, "--background", "--factory-startup", blend,
+           "--python-exit-code", "1",
+           "--python", os.path.abspath(__file__), "--",
+           "--output", args.output, "--name", name, "--format", args.format,
+           "--chunk-size", str(args.chunk_size),
+           "--shard", str(shard), str(shards)]
+    if args.local:
+        cmd.append("--local")
+    if args.no_uv:
+        cmd.append("--no-uv")
+    if args.objects:
+        cmd += ["--objects"] + args.objects
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output, _ = proc.communicate()
+    return (blend, shard, proc.returncode, output)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Export index -> position tables of mesh elements")
+    parser.add_argument("blends", nargs="*",
+                        help=".blend files (default: the opened file)")
+    parser.add_argument("--output", required=True,
+                        help="directory to write tables")
+    parser.add_argument("--format", choices=sorted(WRITERS.keys()),
+                        default="csv")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of Blender processes")
+    parser.add_argument("--objects", nargs="+",
+                        help="names of objects to be exported")
+    parser.add_argument("--local", action="store_true",
+                        help="write positions in object space")
+    parser.add_argument("--no-uv", action="store_true",
+                        help="do not write UV tables")
+    parser.add_argument("--chunk-size", type=int, default=65536,
+                        help="max number of elements per chunk")
+    parser.add_argument("--shard", type=int, nargs=2, default=(0, 1),
+                        metavar=("INDEX", "COUNT"), help=argparse.SUPPRESS)
+    parser.add_argument("--name", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    args = parse_args(argv)
+    os.makedirs(args.output, exist_ok=True)
+
+    if not args.blends:
+        shard, shards = args.shard
+        name = args.name or os.path.splitext(
+            os.path.basename(bpy.data.filepath or "untitled"))[0]
+        path = get_output_path(args, name, shard, shards)
+        export_current(path, args, shard, shards)
+        return 0
+
+    # split objects of each file into shards when there are more
+    # processes than files
+    jobs = max(args.jobs, 1)
+    shards = max(1, jobs // len(args.blends))
+    blends = [os.path.abspath(b) for b in args.blends]
+    names = get_output_names(blends)
+    tasks = [(b, names[b], i, shards) for b in blends for i in range(shards)]
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_worker, args, *t) for t in tasks]
+        for future in futures:
+            blend, shard, code, output = future.result()
+            if code != 0:
+                failed += 1
+                sys.stderr.write(output.decode("utf-8", "replace"))
+            print("{} [{}/{}]: {}".format(blend, shard + 1, shards,
+                                          "failed" if code else "done"))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,23 @@
 # <pep8-80 compliant>
 
+import csv
+import json
+import time
 from math import pi
 
 import bpy
 import bgl
 import blf
 import bmesh
-import mathutils
+import gpu
+import numpy as np
 
-from mathutils import Vector, Matrix
-from bpy_extras import view3d_utils
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
 from bpy.props import *
-from collections import namedtuple
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 
 __author__ = "Nutti <nutti.metro@gmail.com>, tetii"
 __status__ = "Production"
@@ -33,23 +39,1905 @@ bl_info = {
     "category": "UI"
 }
 
-Rect = namedtuple('Rect', 'x0 y0 x1 y1')
+# data passed between the rendering stages of IVRenderer
+MeshSnapshot = namedtuple('MeshSnapshot', 'arrays select_mode world_mat')
+ViewParams = namedtuple(
+    'ViewParams',
+    'width height perspective_matrix view_matrix is_perspective')
+LayoutData = namedtuple('LayoutData', 'indices rects last positions kinds')
+FrameSettings = namedtuple(
+    'FrameSettings',
+    'font_size box_color text_color max_labels hide_overlapped visible_only '
+    'use_worker lod near adaptive nav_labels settle_time cache_layer '
+    'time_budget all_kinds kind_colors')
+NearQuery = namedtuple('NearQuery', 'source center radius')
+MeshArrays = namedtuple(
+    'MeshArrays',
+    'co vert_sel edge_verts edge_sel loop_verts loop_edges '
+    'face_loop_start face_loop_total face_sel')
+UVLayoutData = namedtuple(
+    'UVLayoutData', 'indices origins angles widths heights ch_counts kinds')
+UVLabelData = namedtuple('UVLabelData', 'labels faces')
+
+# number of elements processed in the first chunk of progressive
+# rendering. Following chunks are sized from the measured time per element
+PROGRESSIVE_CHUNK = 4096
+PROGRESSIVE_UV_CHUNK = 256
+
+# minimum number of labels examined at once in label layout
+LAYOUT_BLOCK = 64
+
+# UV labels of the same element closer than this on screen are merged
+UV_MERGE_PIXELS = 1.0
+
+# color and offset of shadows of UV loop indices
+UV_SHADOW_COLOR = (1.0, 0.0, 0.0, 1.0)
+UV_SHADOW_OFFSET = (2, -2)
+
+# kinds of labels
+LABEL_VERT = 0
+LABEL_EDGE = 1
+LABEL_LOOP = 2
+LABEL_FACE = 3
+
+# offsets of labels by kind in label height, so that vert/edge/face labels
+# at the same place are not overlapped when they are rendered together
+KIND_OFFSETS = np.array([[0.0, 0.0], [0.0, -0.5], [0.0, 0.0], [0.0, 0.5]],
+                        dtype=np.float32)
+
+
+class LabelBuffer:
+    """Struct-of-arrays of labels passed between the rendering stages.
+
+    Labels are kept in contiguous int32 indices, float32 positions (xyz in
+    View3D, uv in UV Editor), float32 region positions (screen) and uint8
+    kinds, plus UV tangents and normals if oriented is True. Arrays are
+    allocated with spare capacity and reused while labels fit in them, so
+    that a buffer refilled on each frame does not reallocate.
+    last is the last indices of clustered labels, or None."""
+
+    __slots__ = ('indices', 'positions', 'screen', 'kinds', 'tangents',
+                 'normals', 'last', '__dim', '__oriented', '__capacity',
+                 '__storage')
+
+    def __init__(self, dim=3, oriented=False):
+        self.__dim = dim
+        self.__oriented = oriented
+        self.__capacity = -1
+        self.__storage = None
+        self.resize(0)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def resize(self, n):
+        """Make buffer hold n labels. Contents are undefined."""
+        if n > self.__capacity:
+            cap = max(n, self.__capacity * 3 // 2, 64)
+            storage = [np.empty(cap, dtype=np.int32),
+                       np.empty((cap, self.__dim), dtype=np.float32),
+                       np.empty((cap, 2), dtype=np.float32),
+                       np.empty(cap, dtype=np.uint8)]
+            if self.__oriented:
+                storage.append(np.empty((cap, 2), dtype=np.float32))
+                storage.append(np.empty((cap, 2), dtype=np.float32))
+            self.__storage = storage
+            self.__capacity = cap
+        self.__set_arrays([a[:n] for a in self.__storage])
+        self.last = None
+        return self
+
+    def fill(self, indices, positions, kinds=LABEL_VERT, tangents=None,
+             normals=None, offset=0):
+        """Copy labels into the buffer from offset. Buffer must be resized
+        to hold them before. Labels without tangents are horizontal."""
+        end = offset + len(indices)
+        self.indices[offset:end] = indices
+        self.positions[offset:end] = positions
+        self.kinds[offset:end] = kinds
+        if self.__oriented:
+            self.tangents[offset:end] = (1.0, 0.0) if tangents is None \
+                else tangents
+            self.normals[offset:end] = (0.0, 1.0) if normals is None \
+                else normals
+        return self
+
+    def concatenate(self, buffers):
+        """Copy labels of buffers into this buffer."""
+        self.resize(sum(len(b) for b in buffers))
+        offset = 0
+        for b in buffers:
+            self.fill(b.indices, b.positions, b.kinds, b.tangents, b.normals,
+                      offset)
+            offset += len(b)
+        return self
+
+    def select(self, key):
+        """Get new buffer of the labels selected by mask, indices or slice.
+        Arrays are copied except for slice, which makes views."""
+        buf = LabelBuffer.__new__(LabelBuffer)
+        buf.__dim = self.__dim
+        buf.__oriented = self.__oriented
+        buf.__capacity = -1
+        buf.__storage = None
+        buf.__set_arrays([a[key] for a in self.__get_arrays()])
+        buf.last = None if self.last is None else self.last[key]
+        return buf
+
+    def __get_arrays(self):
+        arrays = [self.indices, self.positions, self.screen, self.kinds]
+        if self.__oriented:
+            arrays += [self.tangents, self.normals]
+        return arrays
+
+    def __set_arrays(self, arrays):
+        self.indices, self.positions, self.screen, self.kinds = arrays[:4]
+        if self.__oriented:
+            self.tangents, self.normals = arrays[4:]
+        else:
+            self.tangents = self.normals = None
+
+    @staticmethod
+    def from_arrays(indices, positions, kinds=LABEL_VERT, out=None):
+        """Get buffer of labels, reusing out if given."""
+        if out is None:
+            out = LabelBuffer(positions.shape[1])
+        return out.resize(len(indices)).fill(indices, positions, kinds)
+
+
+def get_canvases(positions, ch_counts, font_size):
+    """Get canvases to be rendered indices as Nx4 (x0, y0, x1, y1) array."""
+    half_w = ch_counts * font_size * 0.5
+    half_h = font_size * 1.5 * 0.5
+
+    rects = np.empty((len(positions), 4), dtype=np.int32)
+    rects[:, 0] = positions[:, 0] - half_w
+    rects[:, 1] = positions[:, 1] - half_h
+    rects[:, 2] = positions[:, 0] + half_w
+    rects[:, 3] = positions[:, 1] + half_h
+    return rects
+
+
+def get_rect_quads(rects):
+    """Convert Nx4 rectangles to Nx4x2 quad vertices."""
+    return rects[:, [0, 1, 0, 3, 2, 3, 2, 1]].reshape(-1, 4, 2)
+
+
+def get_float_buffer(values):
+    """Get bgl.Buffer of values as float. Arrays are copied at once by
+    buffer protocol where bgl supports it, and read as sequence
+    otherwise."""
+    values = np.ascontiguousarray(values, dtype=np.float32).ravel()
+    return bgl.Buffer(bgl.GL_FLOAT, len(values), values)
+
+
+DIGIT_THRESHOLDS = np.array([10 ** i for i in range(1, 19)], dtype=np.int64)
+
+
+def get_digit_counts(indices):
+    """Get the number of characters of each index."""
+    return np.searchsorted(DIGIT_THRESHOLDS, indices, side='right') + 1
+
+
+# separator of summary label "first-last" of clustered labels
+RANGE_SEPARATOR = "\u2013"
+
+
+def get_label_lengths(indices, last=None):
+    """Get the number of characters of label texts. Label whose last index
+    differs from its index is rendered as range "index-last"."""
+    counts = get_digit_counts(indices)
+    if last is not None:
+        counts = counts + np.where(last != indices,
+                                   get_digit_counts(last) + 1, 0)
+    return counts
+
+
+def get_label_text(index, last):
+    if index == last:
+        return str(index)
+    return "{}{}{}".format(index, RANGE_SEPARATOR, last)
+
+
+class CoverageMap:
+    """Pixel raster of the area covered by accepted label rectangles.
+
+    Canvases are integer rectangles, so a rectangle overlaps an accepted
+    label if and only if it contains a covered pixel. Prefix sums of each
+    row are kept, so that many rectangles are tested at once and only the
+    rows of a label are updated when it is accepted."""
+
+    def __init__(self):
+        self.__bounds = (0, 0, 0, 0)
+        self.__covered = np.zeros((0, 0), dtype=np.bool_)
+        self.__sums = np.zeros((0, 1), dtype=np.int32)
+
+    def reserve(self, x0, y0, x1, y1):
+        """Extend raster to contain the area."""
+        bx0, by0, bx1, by1 = self.__bounds
+        if bx0 <= x0 and by0 <= y0 and x1 <= bx1 and y1 <= by1:
+            return
+        nx0, ny0 = min(x0, bx0), min(y0, by0)
+        nx1, ny1 = max(x1, bx1), max(y1, by1)
+        covered = np.zeros((ny1 - ny0, nx1 - nx0), dtype=np.bool_)
+        covered[by0 - ny0:by1 - ny0, bx0 - nx0:bx1 - nx0] = self.__covered
+        self.__sums = np.zeros((ny1 - ny0, nx1 - nx0 + 1), dtype=np.int32)
+        np.cumsum(covered, axis=1, out=self.__sums[:, 1:])
+        self.__covered = covered
+        self.__bounds = (nx0, ny0, nx1, ny1)
+
+    def add(self, rect):
+        ox, oy = self.__bounds[:2]
+        x0, y0, x1, y1 = rect
+        x0, y0, x1, y1 = x0 - ox, y0 - oy, x1 - ox, y1 - oy
+        # prefix sums after x0 are increased by newly covered pixels
+        added = ~self.__covered[y0:y1, x0:x1]
+        self.__covered[y0:y1, x0:x1] = True
+        counts = added.cumsum(axis=1, dtype=np.int32)
+        self.__sums[y0:y1, x0 + 1:x1 + 1] += counts
+        self.__sums[y0:y1, x1 + 1:] += counts[:, -1:]
+
+    def get_probes(self, rects):
+        """Get raster positions of corners and centers of rectangles.
+        Rectangles must be in the reserved area."""
+        ox, oy, bx1, _ = self.__bounds
+        stride = bx1 - ox
+        x0 = rects[:, 0] - ox
+        x1 = rects[:, 2] - (ox + 1)
+        y0 = (rects[:, 1] - oy).astype(np.intp) * stride
+        y1 = (rects[:, 3] - (oy + 1)).astype(np.intp) * stride
+        yc = ((rects[:, 1] + rects[:, 3] - (2 * oy + 1)) // 2).astype(
+            np.intp) * stride
+        return (y0 + x0, y0 + x1, y1 + x0, y1 + x1,
+                yc + (x0 + x1) // 2)
+
+    def find_free(self, rects, probes):
+        """Get index of the first rectangle which overlaps no covered
+        pixels, or -1. probes are the ones got by get_probes."""
+        # covered corners and centers reject most of rectangles at once
+        covered = self.__covered.ravel()
+        blocked = covered[probes[0]]
+        for p in probes[1:]:
+            blocked |= covered[p]
+        rest = np.flatnonzero(~blocked)
+
+        # others are tested exactly in growing batches until free one is
+        # found, by summing up covered pixels of each row. Last row is
+        # repeated for rectangles lower than the highest one
+        ox, oy = self.__bounds[:2]
+        start = 0
+        size = 16
+        while start < len(rest):
+            part = rest[start:start + size]
+            start += len(part)
+            size *= 2
+            x0 = rects[part, 0] - ox
+            y0 = rects[part, 1] - oy
+            x1 = rects[part, 2] - ox
+            y1 = rects[part, 3] - oy
+            rows = np.minimum(y0[:, np.newaxis] + np.arange((y1 - y0).max()),
+                              (y1 - 1)[:, np.newaxis])
+            sums = self.__sums[rows, x1[:, np.newaxis]] - \
+                self.__sums[rows, x0[:, np.newaxis]]
+            free = np.flatnonzero(~sums.any(axis=1))
+            if len(free) > 0:
+                return int(part[free[0]])
+        return -1
+
+
+def layout_labels(rects, width, height, max_labels, hide_overlapped=True,
+                  priority=None, accept=None, grid=None):
+    """Get indices of the labels to be rendered.
+
+    Labels outside of region are culled and, if hide_overlapped is True,
+    labels overlapping already accepted ones are rejected by using
+    CoverageMap. At most max_labels labels are accepted.
+    If priority is given, labels with lower priority value are examined
+    first. If accept is given, it is called for each label which survived
+    culling and the label is rejected when it returns False.
+    If grid is given, labels accepted in the previous calls with the grid
+    are also taken into account.
+    Labels are examined in blocks, and labels of a block overlapping
+    accepted ones are rejected at once until the first free one, so only
+    free labels are handled one by one."""
+    inside = (rects[:, 2] >= 0) & (rects[:, 0] < width) & \
+             (rects[:, 3] >= 0) & (rects[:, 1] < height)
+    candidates = np.flatnonzero(inside)
+    if priority is not None:
+        candidates = candidates[np.argsort(priority[candidates],
+                                           kind='mergesort')]
+    if not hide_overlapped or len(candidates) == 0:
+        if accept is None:
+            return candidates[:max_labels]
+        accepted = []
+        for i in candidates.tolist():
+            if accept(i):
+                accepted.append(i)
+                if len(accepted) >= max_labels:
+                    break
+        return np.array(accepted, dtype=np.int64)
+
+    if grid is None:
+        grid = CoverageMap()
+    r = rects[candidates]
+    grid.reserve(int(r[:, 0].min()), int(r[:, 1].min()),
+                 int(r[:, 2].max()), int(r[:, 3].max()))
+    probes = grid.get_probes(r)
+
+    accepted = []
+    pos = 0
+    block = LAYOUT_BLOCK
+    while pos < len(candidates) and len(accepted) < max_labels:
+        j = grid.find_free(r[pos:pos + block],
+                           [p[pos:pos + block] for p in probes])
+        if j < 0:
+            pos += block
+            block *= 2
+            continue
+        # labels after the free one are examined again with it
+        block = max((j + 1) * 2, LAYOUT_BLOCK)
+        j += pos
+        pos = j + 1
+        i = int(candidates[j])
+        if (accept is not None) and (not accept(i)):
+            continue
+        accepted.append(i)
+        grid.add(r[j].tolist())
+
+    return np.array(accepted, dtype=np.int64)
+
+
+class LabelHierarchy:
+    """Octree of labels for level-of-detail clustering.
+
+    Labels are sorted once by Morton code of their world positions, so that
+    a cluster of any level is a contiguous run of the sorted labels. Kind
+    is put above the Morton code, so labels of different kinds are never
+    clustered together. Changing zoom only picks another level, whose
+    clusters are computed on first use and kept."""
+
+    MAX_LEVEL = 10
+    # labels are clustered while a cell is narrower than this many digits
+    CELL_CHARS = 4
+
+    def __init__(self, indices, positions, kinds=LABEL_VERT):
+        self.__levels = {}
+        self.__count = len(indices)
+        kinds = np.broadcast_to(np.asarray(kinds, dtype=np.uint8),
+                                (self.__count,))
+        if self.__count == 0:
+            self.__corners = np.zeros((8, 3), dtype=np.float32)
+            self.__codes = np.empty(0, dtype=np.int64)
+            self.__indices = indices
+            self.__positions = positions
+            self.__kinds = kinds
+            return
+
+        lo = positions.min(axis=0)
+        size = max(float((positions.max(axis=0) - lo).max()), 1e-6)
+        corners = np.array([[x, y, z] for x in (0, 1) for y in (0, 1)
+                            for z in (0, 1)], dtype=np.float32)
+        self.__corners = lo + corners * size
+
+        res = 1 << self.MAX_LEVEL
+        q = np.clip(((positions - lo) * (res / size)).astype(np.int64),
+                    0, res - 1)
+        codes = kinds.astype(np.int64) << (3 * self.MAX_LEVEL)
+        for b in range(self.MAX_LEVEL):
+            for axis in range(3):
+                codes |= ((q[:, axis] >> b) & 1) << (3 * b + axis)
+
+        order = np.argsort(codes, kind='mergesort')
+        self.__codes = codes[order]
+        self.__indices = indices[order]
+        self.__positions = positions[order].astype(np.float64)
+        self.__kinds = kinds[order]
+
+    def pick_level(self, view, cell_size):
+        """Get the deepest level whose cells are not smaller than cell_size
+        pixels on region. Return None if labels need not be clustered."""
+        if self.__count <= 1:
+            return None
+        screen, visible = project_points(view, self.__corners)
+        # bounding box crossing the viewer is zoomed in enough
+        if not visible.all():
+            return None
+        extent = float((screen.max(axis=0) - screen.min(axis=0)).max())
+        if extent < cell_size:
+            return 0
+        level = int(np.log2(extent / cell_size))
+        if level >= self.MAX_LEVEL:
+            return None
+        return level
+
+    def get_clusters(self, level):
+        """Get clusters of the level as LabelBuffer of first indices,
+        centroids and kinds, and last indices of the clusters."""
+        clusters = self.__levels.get(level)
+        if clusters is not None:
+            return clusters
+
+        keys = self.__codes >> (3 * (self.MAX_LEVEL - level))
+        starts = np.flatnonzero(np.concatenate(([True],
+                                                keys[1:] != keys[:-1])))
+        counts = np.diff(np.append(starts, self.__count))
+        first = np.minimum.reduceat(self.__indices, starts)
+        last = np.maximum.reduceat(self.__indices, starts)
+        centroids = np.add.reduceat(self.__positions, starts, axis=0) / \
+            counts[:, np.newaxis]
+        clusters = (LabelBuffer.from_arrays(first, centroids,
+                                            self.__kinds[starts]), last)
+        self.__levels[level] = clusters
+        return clusters
+
+
+class OcclusionTester:
+    """Test whether labels are occluded by geometry with ray casting against
+    BVHTree cached for each object."""
+
+    def __init__(self):
+        self.__trees = {}
+
+    def invalidate(self):
+        self.__trees = {}
+
+    def update(self, objects):
+        """Rebuild BVHTree of (object, bmesh) pairs only when geometry is
+        changed."""
+        trees = {}
+        for obj, bm in objects:
+            ptr = obj.as_pointer()
+            key = (len(bm.verts), len(bm.edges), len(bm.faces))
+            tree = self.__trees.get(ptr)
+            if (tree is None) or (tree[0] != key):
+                bb = np.array([tuple(v) for v in obj.bound_box],
+                              dtype=np.float32)
+                eps = max(float(np.ptp(bb, axis=0).max()) * 1e-4, 1e-6)
+                tree = (key, BVHTree.FromBMesh(bm), eps)
+            trees[ptr] = (tree[0], tree[1], tree[2], obj.matrix_world.copy())
+        self.__trees = trees
+
+    def get_visibility_func(self, view, positions):
+        """Get depth of labels from viewer and function which tells whether
+        i-th label is visible."""
+        view_inv = view.view_matrix.inverted()
+        perspective = view.is_perspective
+        if perspective:
+            viewer = np.array(view_inv.translation, dtype=np.float32)
+            d = viewer - positions
+            depth = np.sqrt((d * d).sum(axis=1))
+        else:
+            axis = np.array(view_inv.col[2].xyz, dtype=np.float32)
+            depth = -np.dot(positions, axis)
+
+        # ray cast in object space, from label toward viewer
+        rays = []
+        for _, bvh, eps, world_mat in self.__trees.values():
+            inv = world_mat.inverted()
+            co = transform_points(inv, positions)
+            if perspective:
+                dirs = np.array(inv * view_inv.translation,
+                                dtype=np.float32) - co
+                dists = np.sqrt((dirs * dirs).sum(axis=1))
+                dirs /= np.maximum(dists, 1e-12)[:, np.newaxis]
+                dists -= eps * 2.0
+            else:
+                local_axis = np.array(inv.to_3x3() * view_inv.col[2].xyz,
+                                      dtype=np.float32)
+                local_axis /= max(
+                    float(np.sqrt((local_axis * local_axis).sum())), 1e-12)
+                dirs = np.tile(local_axis, (len(co), 1))
+                dists = np.full(len(co), 1.0e30, dtype=np.float32)
+            rays.append((bvh, co + dirs * eps, dirs, dists))
+
+        def is_visible(i):
+            for bvh, origins, dirs, dists in rays:
+                hit = bvh.ray_cast(Vector(origins[i].tolist()),
+                                   Vector(dirs[i].tolist()), float(dists[i]))
+                if hit[0] is not None:
+                    return False
+            return True
+
+        return (depth, is_visible)
+
+
+def draw_quads(verts):
+    """Draw Nx2 quad vertices with one draw call."""
+    n = len(verts)
+    if n == 0:
+        return
+    if hasattr(bgl, "glVertexAttribPointer"):
+        # vertex attribute 0 is aliased to the vertex position
+        buf = get_float_buffer(verts)
+        bgl.glEnableVertexAttribArray(0)
+        bgl.glVertexAttribPointer(0, 2, bgl.GL_FLOAT, bgl.GL_FALSE, 0, buf)
+        bgl.glDrawArrays(bgl.GL_QUADS, 0, n)
+        bgl.glDisableVertexAttribArray(0)
+    else:
+        bgl.glBegin(bgl.GL_QUADS)
+        for x, y in verts.tolist():
+            bgl.glVertex2f(x, y)
+        bgl.glEnd()
+
+
+class QuadBatch:
+    """Batch of 2D quads rendered with one draw call per color."""
+
+    def __init__(self):
+        self.__quads = {}
+
+    def add(self, quads, color):
+        quads = np.asarray(quads, dtype=np.float32).reshape(-1, 4, 2)
+        self.__quads.setdefault(tuple(color), []).append(quads)
+
+    def clear(self):
+        self.__quads = {}
+
+    def draw(self):
+        if not self.__quads:
+            return
+        bgl.glEnable(bgl.GL_BLEND)
+        for color, chunks in self.__quads.items():
+            bgl.glColor4f(*color)
+            draw_quads(np.concatenate(chunks).reshape(-1, 2))
+        bgl.glColor4f(1.0, 1.0, 1.0, 1.0)
+
+
+def compile_program(vertex_shader, fragment_shader):
+    """Compile and link GLSL program. Return None on failure."""
+    status = bgl.Buffer(bgl.GL_INT, 1)
+    program = bgl.glCreateProgram()
+    for shader_type, source in ((bgl.GL_VERTEX_SHADER, vertex_shader),
+                                (bgl.GL_FRAGMENT_SHADER, fragment_shader)):
+        shader = bgl.glCreateShader(shader_type)
+        bgl.glShaderSource(shader, source)
+        bgl.glCompileShader(shader)
+        bgl.glGetShaderiv(shader, bgl.GL_COMPILE_STATUS, status)
+        if status[0] == 0:
+            bgl.glDeleteShader(shader)
+            bgl.glDeleteProgram(program)
+            return None
+        bgl.glAttachShader(program, shader)
+        bgl.glDeleteShader(shader)
+    bgl.glLinkProgram(program)
+    bgl.glGetProgramiv(program, bgl.GL_LINK_STATUS, status)
+    if status[0] == 0:
+        bgl.glDeleteProgram(program)
+        return None
+    return program
+
+
+class GlyphAtlas:
+    """Texture atlas of digits 0-9 and range separator rasterized once per
+    font size.
+
+    Indices are drawn as textured quads of the digits in one draw call.
+    Text color is given as uniform, so changing color does not need
+    re-rasterization."""
+
+    PADDING = 2
+    SEPARATOR = 10
+    GLYPHS = [str(d) for d in range(10)] + [RANGE_SEPARATOR]
+    POWERS = np.array([10 ** i for i in range(19)], dtype=np.int64)
+
+    VERTEX_SHADER = """
+        #version 120
+        attribute vec2 pos;
+        attribute vec2 uv;
+        varying vec2 uv_interp;
+        void main()
+        {
+            uv_interp = uv;
+            gl_Position = gl_ModelViewProjectionMatrix * vec4(pos, 0.0, 1.0);
+        }
+    """
+
+    FRAGMENT_SHADER = """
+        #version 120
+        uniform sampler2D glyphs;
+        uniform vec4 color;
+        varying vec2 uv_interp;
+        void main()
+        {
+            // digits are rasterized in white on black, red is coverage
+            float a = texture2D(glyphs, uv_interp).r;
+            gl_FragColor = vec4(color.rgb, color.a * a);
+        }
+    """
+
+    __dimensions = {}
+
+    def __init__(self):
+        self.__offscreen = None
+        self.__program = None
+        self.__font_size = None
+        self.__advances = None
+        self.__cell_w = 0
+        self.__cell_h = 0
+        self.__uvs = None
+
+    @staticmethod
+    def is_supported():
+        return hasattr(gpu, "offscreen") and hasattr(bgl, "glCreateShader")
+
+    @classmethod
+    def get_text_dimensions(cls, font_size, ch_count):
+        """Get (width, height) of index text with ch_count digits."""
+        key = (font_size, ch_count)
+        if key not in cls.__dimensions:
+            blf.size(0, font_size, 72)
+            cls.__dimensions[key] = blf.dimensions(0, "0" * ch_count)
+        return cls.__dimensions[key]
+
+    def free(self):
+        if self.__offscreen is not None:
+            self.__offscreen.free()
+            self.__offscreen = None
+        if self.__program is not None:
+            bgl.glDeleteProgram(self.__program)
+            self.__program = None
+        self.__font_size = None
+
+    def ensure(self, font_size):
+        """Rasterize digits if font size is changed. Return False if atlas
+        can not be used."""
+        if self.__program is None:
+            self.__program = compile_program(self.VERTEX_SHADER,
+                                             self.FRAGMENT_SHADER)
+            if self.__program is None:
+                return False
+        if self.__font_size == font_size:
+            return True
+
+        pad = self.PADDING
+        blf.size(0, font_size, 72)
+        advances = [blf.dimensions(0, g)[0] for g in self.GLYPHS]
+        cell_w = int(max(advances)) + 1 + pad * 2
+        cell_h = int(font_size * 1.5) + pad * 2
+        width = cell_w * len(self.GLYPHS)
+
+        if self.__offscreen is not None:
+            self.__offscreen.free()
+        self.__offscreen = gpu.offscreen.new(width, cell_h)
+        self.__offscreen.bind()
+        try:
+            bgl.glClearColor(0.0, 0.0, 0.0, 0.0)
+            bgl.glClear(bgl.GL_COLOR_BUFFER_BIT)
+            bgl.glMatrixMode(bgl.GL_PROJECTION)
+            bgl.glPushMatrix()
+            bgl.glLoadIdentity()
+            bgl.glOrtho(0, width, 0, cell_h, -1, 1)
+            bgl.glMatrixMode(bgl.GL_MODELVIEW)
+            bgl.glPushMatrix()
+            bgl.glLoadIdentity()
+
+            blf.disable(0, blf.SHADOW)
+            bgl.glColor4f(1.0, 1.0, 1.0, 1.0)
+            for i, g in enumerate(self.GLYPHS):
+                blf.position(0, i * cell_w + pad, pad, 0)
+                blf.draw(0, g)
+
+            bgl.glMatrixMode(bgl.GL_PROJECTION)
+            bgl.glPopMatrix()
+            bgl.glMatrixMode(bgl.GL_MODELVIEW)
+            bgl.glPopMatrix()
+        finally:
+            self.__offscreen.unbind()
+
+        self.__font_size = font_size
+        self.__advances = np.array(advances, dtype=np.float32)
+        self.__cell_w = cell_w
+        self.__cell_h = cell_h
+        # texture coordinates of quads of each glyph
+        u0 = np.arange(len(self.GLYPHS), dtype=np.float32) / len(self.GLYPHS)
+        u1 = u0 + 1.0 / len(self.GLYPHS)
+        zeros = np.zeros(len(u0), dtype=np.float32)
+        ones = np.ones(len(u0), dtype=np.float32)
+        self.__uvs = np.stack([u0, zeros, u0, ones, u1, ones, u1, zeros],
+                              axis=1)
+        return True
+
+    @classmethod
+    def __get_digit_codes(cls, indices):
+        counts = get_digit_counts(indices)
+        n = int(counts.sum())
+        label = np.repeat(np.arange(len(indices)), counts)
+        start = np.cumsum(counts) - counts
+        # position of the digit in the index text, from left
+        k = np.arange(n) - start[label]
+        digits = (indices[label] // cls.POWERS[counts[label] - 1 - k]) % 10
+        return (digits, label)
+
+    @classmethod
+    def get_glyph_codes(cls, indices, last=None):
+        """Get glyphs of label texts in text order, and label of each
+        glyph."""
+        codes, label = cls.__get_digit_codes(indices)
+        if last is None:
+            return (codes, label)
+        ranged = np.flatnonzero(last != indices)
+        if len(ranged) == 0:
+            return (codes, label)
+        tail_codes, tail_label = cls.__get_digit_codes(last[ranged])
+        codes = np.concatenate(
+            (codes, np.full(len(ranged), cls.SEPARATOR), tail_codes))
+        label = np.concatenate((label, ranged, ranged[tail_label]))
+        # stable sort keeps "index", separator, "last" order in a label
+        order = np.argsort(label, kind='mergesort')
+        return (codes[order], label[order])
+
+    def get_glyph_quads(self, indices, origins, last=None, angles=None):
+        """Get quad vertices and texture coordinates of glyphs of labels
+        whose text origins are origins. If angles is given, labels are
+        rotated around their text origins as blf does."""
+        digits, label = self.get_glyph_codes(indices, last)
+        n = len(digits)
+        counts = np.bincount(label, minlength=len(indices))
+        start = np.cumsum(counts) - counts
+
+        adv = self.__advances[digits]
+        x_off = np.cumsum(adv) - adv
+        x_off -= x_off[start][label]
+
+        # corners of glyph cells are left corners of the label moved along
+        # its baseline, all of which are rotated as the label
+        pad = self.PADDING
+        heights = np.array([-pad, self.__cell_h - pad, self.__cell_h - pad,
+                            -pad], dtype=np.float32)
+        if angles is None:
+            angles = np.zeros(len(indices), dtype=np.float32)
+        cos = np.cos(angles).astype(np.float32)
+        sin = np.sin(angles).astype(np.float32)
+        bases = np.empty((len(indices), 8), dtype=np.float32)
+        bases[:, 0::2] = origins[:, 0:1] - sin[:, np.newaxis] * heights
+        bases[:, 1::2] = origins[:, 1:2] + cos[:, np.newaxis] * heights
+
+        x0 = x_off - pad
+        x1 = x0 + self.__cell_w
+        xs = np.stack([x0, x0, x1, x1], axis=1)
+        verts = bases.take(label, axis=0)
+        verts[:, 0::2] += xs * cos.take(label)[:, np.newaxis]
+        verts[:, 1::2] += xs * sin.take(label)[:, np.newaxis]
+
+        return (verts.reshape(-1, 2),
+                self.__uvs.take(digits, axis=0).reshape(-1, 2))
+
+    def draw(self, indices, origins, color, last=None, angles=None):
+        """Draw indices at text origins in one draw call."""
+        if len(indices) == 0:
+            return
+        verts, uvs = self.get_glyph_quads(indices, origins, last, angles)
+        n = len(verts)
+        program = self.__program
+        pos_buf = get_float_buffer(verts)
+        uv_buf = get_float_buffer(uvs)
+
+        bgl.glUseProgram(program)
+        bgl.glEnable(bgl.GL_BLEND)
+        bgl.glActiveTexture(bgl.GL_TEXTURE0)
+        bgl.glBindTexture(bgl.GL_TEXTURE_2D, self.__offscreen.color_texture)
+        bgl.glUniform1i(bgl.glGetUniformLocation(program, "glyphs"), 0)
+        bgl.glUniform4f(bgl.glGetUniformLocation(program, "color"), *color)
+
+        pos_loc = bgl.glGetAttribLocation(program, "pos")
+        uv_loc = bgl.glGetAttribLocation(program, "uv")
+        bgl.glEnableVertexAttribArray(pos_loc)
+        bgl.glEnableVertexAttribArray(uv_loc)
+        bgl.glVertexAttribPointer(pos_loc, 2, bgl.GL_FLOAT, bgl.GL_FALSE, 0,
+                                  pos_buf)
+        bgl.glVertexAttribPointer(uv_loc, 2, bgl.GL_FLOAT, bgl.GL_FALSE, 0,
+                                  uv_buf)
+        bgl.glDrawArrays(bgl.GL_QUADS, 0, n)
+        bgl.glDisableVertexAttribArray(pos_loc)
+        bgl.glDisableVertexAttribArray(uv_loc)
+
+        bgl.glBindTexture(bgl.GL_TEXTURE_2D, 0)
+        bgl.glUseProgram(0)
+
+
+class LayerCache:
+    """Rendered label layer of each region kept in offscreen buffer.
+
+    While key and source of a region are not changed, the layer is
+    composited with one textured quad instead of rendering all boxes and
+    texts again. Colors are rendered over transparent black while alpha is
+    accumulated as coverage, so the layer holds premultiplied alpha and is
+    composited as such."""
+
+    VERTEX_SHADER = GlyphAtlas.VERTEX_SHADER
+
+    FRAGMENT_SHADER = """
+        #version 120
+        uniform sampler2D layer;
+        varying vec2 uv_interp;
+        void main()
+        {
+            gl_FragColor = texture2D(layer, uv_interp);
+        }
+    """
+
+    def __init__(self):
+        # region -> [key, source, offscreen, width, height]
+        self.__layers = {}
+        self.__program = None
+
+    @staticmethod
+    def is_supported():
+        return GlyphAtlas.is_supported()
+
+    def free(self):
+        for layer in self.__layers.values():
+            layer[2].free()
+        self.__layers = {}
+        if self.__program is not None:
+            bgl.glDeleteProgram(self.__program)
+            self.__program = None
+
+    def discard(self, region):
+        """Free the layer of region."""
+        layer = self.__layers.pop(region.as_pointer(), None)
+        if layer is not None:
+            layer[2].free()
+
+    def draw(self, region, key, source, draw_func, *args):
+        """Composite layer of region. draw_func(*args) renders the layer
+        again when key is changed or source is not the same object.
+        Return True if the cached layer is used."""
+        if self.__program is None:
+            self.__program = compile_program(self.VERTEX_SHADER,
+                                             self.FRAGMENT_SHADER)
+            if self.__program is None:
+                draw_func(*args)
+                return False
+
+        layer = self.__layers.get(region.as_pointer())
+        hit = (layer is not None) and (layer[0] == key) and \
+            (layer[1] is source) and \
+            (layer[3:] == [region.width, region.height])
+        if not hit:
+            layer = self.__render(region, key, source, True, draw_func, args)
+        self.__composite(layer[2], region.width, region.height)
+        return hit
+
+    def append(self, region, key, draw_func, *args):
+        """Render more by draw_func(*args) on the layer of region, and
+        composite it. The layer is cleared only when key is changed."""
+        if self.__program is None:
+            self.__program = compile_program(self.VERTEX_SHADER,
+                                             self.FRAGMENT_SHADER)
+            if self.__program is None:
+                draw_func(*args)
+                return
+        layer = self.__render(region, key, None, False, draw_func, args)
+        self.__composite(layer[2], region.width, region.height)
+
+    def __render(self, region, key, source, clear, draw_func, args):
+        ptr = region.as_pointer()
+        width = region.width
+        height = region.height
+        layer = self.__layers.get(ptr)
+        if (layer is None) or (layer[3:] != [width, height]):
+            if layer is not None:
+                layer[2].free()
+            offscreen = gpu.offscreen.new(width, height)
+            clear = True
+        else:
+            offscreen = layer[2]
+            clear = clear or (layer[0] != key)
+        offscreen.bind()
+        try:
+            if clear:
+                bgl.glClearColor(0.0, 0.0, 0.0, 0.0)
+                bgl.glClear(bgl.GL_COLOR_BUFFER_BIT)
+            # blending alpha by SRC_ALPHA would store alpha squared
+            bgl.glBlendFuncSeparate(bgl.GL_SRC_ALPHA,
+                                    bgl.GL_ONE_MINUS_SRC_ALPHA,
+                                    bgl.GL_ONE, bgl.GL_ONE_MINUS_SRC_ALPHA)
+            draw_func(*args)
+        finally:
+            bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE_MINUS_SRC_ALPHA)
+            offscreen.unbind()
+        layer = self.__layers[ptr] = [key, source, offscreen, width, height]
+        return layer
+
+    def __composite(self, offscreen, width, height):
+        program = self.__program
+        pos_buf = bgl.Buffer(bgl.GL_FLOAT, 8,
+                             [0, 0, 0, height, width, height, width, 0])
+        uv_buf = bgl.Buffer(bgl.GL_FLOAT, 8, [0, 0, 0, 1, 1, 1, 1, 0])
+
+        bgl.glUseProgram(program)
+        bgl.glEnable(bgl.GL_BLEND)
+        bgl.glBlendFunc(bgl.GL_ONE, bgl.GL_ONE_MINUS_SRC_ALPHA)
+        bgl.glActiveTexture(bgl.GL_TEXTURE0)
+        bgl.glBindTexture(bgl.GL_TEXTURE_2D, offscreen.color_texture)
+        bgl.glUniform1i(bgl.glGetUniformLocation(program, "layer"), 0)
+
+        pos_loc = bgl.glGetAttribLocation(program, "pos")
+        uv_loc = bgl.glGetAttribLocation(program, "uv")
+        bgl.glEnableVertexAttribArray(pos_loc)
+        bgl.glEnableVertexAttribArray(uv_loc)
+        bgl.glVertexAttribPointer(pos_loc, 2, bgl.GL_FLOAT, bgl.GL_FALSE, 0,
+                                  pos_buf)
+        bgl.glVertexAttribPointer(uv_loc, 2, bgl.GL_FLOAT, bgl.GL_FALSE, 0,
+                                  uv_buf)
+        bgl.glDrawArrays(bgl.GL_QUADS, 0, 4)
+        bgl.glDisableVertexAttribArray(pos_loc)
+        bgl.glDisableVertexAttribArray(uv_loc)
+
+        bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE_MINUS_SRC_ALPHA)
+        bgl.glBindTexture(bgl.GL_TEXTURE_2D, 0)
+        bgl.glUseProgram(0)
+
+
+class ProgressiveTask:
+    """Generator pipeline resumed on each redraw under time budget.
+
+    The generator processes chunk elements first, and yields (progress,
+    partial result) after each chunk of work. The number of elements of
+    the next chunk is sent back to it, which is sized from the measured
+    time per element so that a chunk fits in the rest of the budget. At
+    least one chunk is processed per run, so the task always advances."""
+
+    MIN_CHUNK = 64
+
+    def __init__(self, key, generator, chunk):
+        self.key = key
+        self.__generator = generator
+        self.__started = False
+        self.__chunk = chunk
+        # seconds per element
+        self.__cost = None
+        self.progress = 0.0
+        self.result = None
+        self.done = False
+
+    def run(self, budget):
+        """Resume pipeline until budget seconds pass or it is finished."""
+        if self.done:
+            return
+        now = time.perf_counter()
+        deadline = now + budget
+        try:
+            while True:
+                if self.__cost is not None:
+                    self.__chunk = max(int((deadline - now) / self.__cost),
+                                       self.MIN_CHUNK)
+                if self.__started:
+                    self.progress, self.result = \
+                        self.__generator.send(self.__chunk)
+                else:
+                    self.progress, self.result = next(self.__generator)
+                    self.__started = True
+                start = now
+                now = time.perf_counter()
+                cost = max(now - start, 1e-9) / self.__chunk
+                self.__cost = cost if self.__cost is None \
+                    else (self.__cost + cost) * 0.5
+                if now >= deadline:
+                    return
+        except StopIteration:
+            pass
+        self.progress = 1.0
+        self.done = True
+
+
+class LayoutBuilder:
+    """LayoutData grown by appending partial layouts. Arrays are allocated
+    with spare capacity, so appending a layout copies only the layout."""
+
+    def __init__(self):
+        self.__arrays = [np.empty(0, dtype=np.int64),
+                         np.empty((0, 4), dtype=np.int32),
+                         np.empty((0, 3), dtype=np.float32),
+                         np.empty(0, dtype=np.uint8)]
+        self.__count = 0
+
+    def append(self, layout):
+        parts = [layout.indices, layout.rects, layout.positions, layout.kinds]
+        start = self.__count
+        end = start + len(layout.indices)
+        if end > len(self.__arrays[0]):
+            cap = max(end, len(self.__arrays[0]) * 2, 64)
+            arrays = []
+            for a, p in zip(self.__arrays, parts):
+                b = np.empty((cap,) + p.shape[1:], dtype=p.dtype)
+                b[:start] = a[:start]
+                arrays.append(b)
+            self.__arrays = arrays
+        for a, p in zip(self.__arrays, parts):
+            a[start:end] = p
+        self.__count = end
+
+    def get(self):
+        """Get LayoutData of the appended layouts. Arrays are views, which
+        are not changed by later appends."""
+        n = self.__count
+        indices, rects, positions, kinds = [a[:n] for a in self.__arrays]
+        return LayoutData(indices=indices, rects=rects, last=None,
+                          positions=positions, kinds=kinds)
+
+
+def draw_progress(region, progress, font_size=11):
+    """Render progress of progressive rendering at the left bottom corner
+    of region."""
+    blf.size(0, font_size, 72)
+    bgl.glColor4f(1.0, 1.0, 1.0, 0.8)
+    blf.position(0, font_size, font_size, 0)
+    blf.draw(0, "Indexing... {:.0%}".format(progress))
+
+
+class FrameRecord:
+    """Stage timings, label counts and cache hits of a frame."""
+
+    def __init__(self, profiler, source):
+        self.__profiler = profiler
+        self.__last = time.perf_counter()
+        self.time = time.time()
+        self.source = source
+        self.stages = {}
+        self.counts = {}
+        self.hits = {}
+
+    def mark(self):
+        """Start measuring next stage from now."""
+        self.__last = time.perf_counter()
+
+    def lap(self, stage):
+        """Record time elapsed since the last lap as stage's time."""
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.__last
+        self.__last = now
+
+    def count(self, name, n):
+        self.counts[name] = n
+
+    def hit(self, cache, is_hit):
+        hits, total = self.hits.get(cache, (0, 0))
+        self.hits[cache] = (hits + int(is_hit), total + 1)
+
+    def end(self):
+        self.__profiler.append(self)
+
+
+class NullRecord:
+    """Record used while profiling is disabled. Does nothing."""
+
+    def mark(self):
+        pass
+
+    def lap(self, stage):
+        pass
+
+    def count(self, name, n):
+        pass
+
+    def hit(self, cache, is_hit):
+        pass
+
+    def end(self):
+        pass
 
 
-def get_canvas(context, pos, ch_count, font_size):
-    """Get canvas to be rendered index."""
-    sc = context.scene
+NULL_RECORD = NullRecord()
+
+
+class FrameProfiler:
+    """Keep per-frame records of an overlay in fixed-size ring buffer."""
+
+    CAPACITY = 256
+
+    def __init__(self, name):
+        self.name = name
+        self.enabled = False
+        self.__records = deque(maxlen=self.CAPACITY)
+
+    def set_enabled(self, enabled):
+        """Enable or disable recording. Records are cleared when disabled."""
+        self.enabled = enabled
+        if not enabled:
+            self.clear()
+
+    def begin(self, source="main"):
+        """Get record of new frame. NULL_RECORD is returned if disabled."""
+        if not self.enabled:
+            return NULL_RECORD
+        return FrameRecord(self, source)
+
+    def append(self, record):
+        self.__records.append(record)
+
+    def clear(self):
+        self.__records.clear()
+
+    def get_records(self):
+        """Get records as list of flat dict, oldest first."""
+        rows = []
+        for r in list(self.__records):
+            row = {"overlay": self.name, "time": r.time, "source": r.source}
+            for stage, sec in r.stages.items():
+                row["stage_" + stage + "_ms"] = sec * 1000.0
+            for name, n in r.counts.items():
+                row["count_" + name] = n
+            for cache, (hits, total) in r.hits.items():
+                row["hit_" + cache] = hits / total
+            rows.append(row)
+        return rows
+
+    def get_stats(self):
+        """Get averages of stage timings and label counts, and cache hit
+        rates over recorded frames."""
+        records = list(self.__records)
+        stages = {}
+        counts = {}
+        hits = {}
+        for r in records:
+            for stage, sec in r.stages.items():
+                stages.setdefault(stage, []).append(sec * 1000.0)
+            for name, n in r.counts.items():
+                counts.setdefault(name, []).append(n)
+            for cache, (h, t) in r.hits.items():
+                a, b = hits.get(cache, (0, 0))
+                hits[cache] = (a + h, b + t)
+        return {
+            "frames": len(records),
+            "stage_ms": {k: sum(v) / len(v) for k, v in stages.items()},
+            "counts": {k: sum(v) / len(v) for k, v in counts.items()},
+            "hit_rate": {k: h / t for k, (h, t) in hits.items()},
+        }
+
+    def draw_hud(self, region, font_size=11):
+        """Render statistics at the right top corner of region."""
+        stats = self.get_stats()
+        if stats["frames"] == 0:
+            return
+        lines = ["{} ({} frames)".format(self.name, stats["frames"])]
+        lines += ["{}: {:.2f} ms".format(k, v)
+                  for k, v in sorted(stats["stage_ms"].items())]
+        lines += ["{}: {:.0f}".format(k, v)
+                  for k, v in sorted(stats["counts"].items())]
+        lines += ["{} hit: {:.0%}".format(k, v)
+                  for k, v in sorted(stats["hit_rate"].items())]
+
+        blf.size(0, font_size, 72)
+        bgl.glColor4f(1.0, 1.0, 1.0, 0.8)
+        x = region.width - font_size * 16
+        y = region.height - font_size * 2
+        for line in lines:
+            blf.position(0, x, y, 0)
+            blf.draw(0, line)
+            y -= font_size * 1.4
+
+
+def export_stats(filepath, profilers):
+    """Export records of profilers to CSV or JSON file, chosen by file
+    extension."""
+    rows = []
+    for profiler in profilers:
+        rows.extend(profiler.get_records())
+
+    if filepath.lower().endswith(".json"):
+        data = {
+            "stats": {p.name: p.get_stats() for p in profilers},
+            "records": rows,
+        }
+        with open(filepath, "w") as f:
+            json.dump(data, f, indent=1)
+        return
+
+    fields = ["overlay", "time", "source"]
+    for row in rows:
+        fields.extend(sorted(k for k in row.keys() if k not in fields))
+    with open(filepath, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+class LabelWorker:
+    """Run label preparation on a worker thread.
+
+    Result of the last completed job is kept as front buffer and rendered,
+    while the next one is prepared in back. Only the latest request is kept
+    while the worker is busy. Workers given the same executor run their
+    jobs one by one, so that jobs can share caches."""
+
+    def __init__(self, executor=None):
+        self.__executor = executor
+        self.__shared = executor is not None
+        self.__future = None
+        self.__future_key = None
+        self.__next = None
+        self.front = None
+        self.front_key = None
+
+    def is_busy(self):
+        return self.__future is not None
+
+    def request(self, key, func, *args):
+        if self.is_busy():
+            if key == self.__future_key:
+                self.__next = None
+            else:
+                self.__next = (key, func, args)
+            return
+        if key == self.front_key:
+            return
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(max_workers=1)
+        self.__future = self.__executor.submit(func, *args)
+        self.__future_key = key
+
+    def poll(self):
+        """Swap buffers if the job is completed."""
+        future = self.__future
+        if (future is None) or (not future.done()):
+            return
+        self.__future = None
+        self.front = future.result()
+        self.front_key = self.__future_key
+        if self.__next is not None:
+            key, func, args = self.__next
+            self.__next = None
+            self.request(key, func, *args)
+
+    def wait(self):
+        """Wait for the running job and discard pending one."""
+        self.__next = None
+        if self.__future is not None:
+            self.__future.result()
+            self.poll()
+
+    def shutdown(self):
+        self.__next = None
+        if self.__shared:
+            if self.__future is not None:
+                self.__future.result()
+        elif self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+            self.__executor = None
+        self.__future = None
+        self.front = None
+        self.front_key = None
+
+
+def get_change_signature(context, obj, bm):
+    """Get cheap signature which changes when mesh, its selection or
+    object's world matrix is changed."""
+    me = obj.data
+    wm = context.window_manager
+
+    # selection operators are registered to window manager, but view
+    # navigation operators are not
+    ops = wm.operators
+    last_op = ops[-1].as_pointer() if len(ops) > 0 else 0
+
+    return (
+        obj.as_pointer(),
+        frozenset(bm.select_mode),
+        len(bm.verts), len(bm.edges), len(bm.faces),
+        me.total_vert_sel, me.total_edge_sel, me.total_face_sel,
+        tuple(tuple(row) for row in obj.matrix_world),
+        len(ops), last_op
+    )
+
+
+class SnapshotCache:
+    """Cache of data produced by a rendering stage.
+
+    version is unique among all caches, so it can be used as a part of the
+    signature of the data derived from the cached data."""
+
+    __versions = count(1)
+
+    def __init__(self):
+        self.signature = None
+        self.data = None
+        self.dirty = True
+        self.version = 0
+
+    def is_valid(self, signature):
+        return (not self.dirty) and (self.signature == signature)
+
+    def update(self, signature, data):
+        self.signature = signature
+        self.data = data
+        self.dirty = False
+        self.version = next(SnapshotCache.__versions)
+
+    def invalidate(self):
+        self.dirty = True
+
+
+class RegionCache:
+    """Labels cached for a region of View3D.
+
+    Mesh snapshots and collected labels are shared by all regions, while
+    projected and laid out labels, which depend on view matrix and size of
+    the region, are kept for each region. So regions of quad view or of
+    other areas do not invalidate each other's labels."""
+
+    def __init__(self, executor=None):
+        # labels near cursor depend on view
+        self.merged = SnapshotCache()
+        self.merge_buffer = LabelBuffer()
+        self.projected = SnapshotCache()
+        self.layout = SnapshotCache()
+        self.drawn = None
+        self.task = None
+        self.worker = LabelWorker(executor)
 
-    width = ch_count * font_size * 1.0
-    height = font_size * 1.5
 
-    center_x, center_y, len_x, len_y = pos.x, pos.y, width, height
+def foreach_get_array(seq, attr, dtype, width=1):
+    buf = np.empty(len(seq) * width, dtype=dtype)
+    seq.foreach_get(attr, buf)
+    return buf.reshape(-1, width) if width > 1 else buf
 
-    x0 = int(center_x - len_x * 0.5)
-    y0 = int(center_y - len_y * 0.5)
-    x1 = int(center_x + len_x * 0.5)
-    y1 = int(center_y + len_y * 0.5)
-    return Rect(x0, y0, x1, y1)
+
+def read_mesh_arrays(obj, bm):
+    """Read coordinates, connectivity and selection flags of edit mesh into
+    NumPy arrays in bulk."""
+    me = obj.data
+
+    # fallback for the version which can not sync edit mesh to mesh data
+    if not hasattr(obj, "update_from_editmode"):
+        return read_bmesh_arrays(bm)
+
+    obj.update_from_editmode()
+    loop_total = foreach_get_array(me.polygons, "loop_total", np.int32)
+    return MeshArrays(
+        co=foreach_get_array(me.vertices, "co", np.float32, 3),
+        vert_sel=foreach_get_array(me.vertices, "select", np.bool_),
+        edge_verts=foreach_get_array(me.edges, "vertices", np.int32, 2),
+        edge_sel=foreach_get_array(me.edges, "select", np.bool_),
+        loop_verts=foreach_get_array(me.loops, "vertex_index", np.int32),
+        loop_edges=foreach_get_array(me.loops, "edge_index", np.int32),
+        face_loop_start=foreach_get_array(me.polygons, "loop_start", np.int32),
+        face_loop_total=loop_total,
+        face_sel=foreach_get_array(me.polygons, "select", np.bool_)
+    )
+
+
+def read_bmesh_arrays(bm):
+    """Read edit mesh into NumPy arrays directly from bmesh."""
+    loop_total = np.fromiter((len(f.verts) for f in bm.faces), np.int32,
+                             len(bm.faces))
+    loop_start = np.zeros(len(loop_total), dtype=np.int32)
+    np.cumsum(loop_total[:-1], out=loop_start[1:])
+    loop_verts = np.fromiter((v.index for f in bm.faces for v in f.verts),
+                             np.int32, int(loop_total.sum()))
+    loop_edges = np.fromiter((l.edge.index for f in bm.faces for l in f.loops),
+                             np.int32, len(loop_verts))
+    edge_verts = np.fromiter((v.index for e in bm.edges for v in e.verts),
+                             np.int32, len(bm.edges) * 2)
+    return MeshArrays(
+        co=np.array([v.co for v in bm.verts],
+                    dtype=np.float32).reshape(-1, 3),
+        vert_sel=np.fromiter((v.select for v in bm.verts), np.bool_,
+                             len(bm.verts)),
+        edge_verts=edge_verts.reshape(-1, 2),
+        edge_sel=np.fromiter((e.select for e in bm.edges), np.bool_,
+                             len(bm.edges)),
+        loop_verts=loop_verts,
+        loop_edges=loop_edges,
+        face_loop_start=loop_start,
+        face_loop_total=loop_total,
+        face_sel=np.fromiter((f.select for f in bm.faces), np.bool_,
+                             len(bm.faces))
+    )
+
+
+def transform_points(mat, co):
+    """Apply 4x4 matrix to Nx3 points."""
+    m = np.array(mat, dtype=np.float32)
+    return np.dot(co, m[:3, :3].T) + m[:3, 3]
+
+
+def project_points(view, positions, out=None):
+    """Project Nx3 world positions to region in one batch.
+
+    Return Nx2 region positions and mask of the points in front of the
+    viewer (same as view3d_utils.location_3d_to_region_2d but batched).
+    Region positions are written to out if given."""
+    n = len(positions)
+    if n == 0:
+        return (np.empty((0, 2), dtype=np.float32) if out is None else out,
+                np.empty(0, dtype=np.bool_))
+
+    persp_mat = np.array(view.perspective_matrix, dtype=np.float32)
+    co = np.empty((n, 4), dtype=np.float32)
+    co[:, :3] = positions
+    co[:, 3] = 1.0
+    prj = np.dot(co, persp_mat.T)
+
+    visible = prj[:, 3] > 0.0
+    w = np.where(visible, prj[:, 3], 1.0)
+    half_w = view.width / 2.0
+    half_h = view.height / 2.0
+    screen = np.empty((n, 2), dtype=np.float32) if out is None else out
+    screen[:, 0] = half_w + half_w * (prj[:, 0] / w)
+    screen[:, 1] = half_h + half_h * (prj[:, 1] / w)
+    return (screen, visible)
+
+
+def get_view_params(region, rv3d):
+    """Get copy of view parameters which can be used out of draw callback."""
+    return ViewParams(
+        width=region.width,
+        height=region.height,
+        perspective_matrix=rv3d.perspective_matrix.copy(),
+        view_matrix=rv3d.view_matrix.copy(),
+        is_perspective=rv3d.is_perspective
+    )
+
+
+def get_pick_cone(view, center, radius, lo, hi):
+    """Get the ray through center of region as segment (a, b) clipped to
+    the depth range of box lo-hi, and world radii (ra, rb) which radius
+    pixels spans at a and b. Return None if the box is out of the ray."""
+    inv = np.linalg.inv(np.array(view.perspective_matrix, dtype=np.float64))
+    x = center[0] * 2.0 / view.width - 1.0
+    y = center[1] * 2.0 / view.height - 1.0
+    dx = radius * 2.0 / view.width
+    ndc = np.array([[x, y, -1.0, 1.0], [x, y, 1.0, 1.0],
+                    [x + dx, y, -1.0, 1.0], [x + dx, y, 1.0, 1.0]])
+    p = np.dot(ndc, inv.T)
+    p = p[:, :3] / p[:, 3:]
+    near, far = p[0], p[1]
+    rn = float(np.linalg.norm(p[2] - near))
+    rf = float(np.linalg.norm(p[3] - far))
+
+    # depth in view space is linear along the ray
+    vz = np.array(view.view_matrix, dtype=np.float64)[2]
+    corners = np.array([[x, y, z] for x in (lo[0], hi[0])
+                        for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+    zc = np.dot(corners, vz[:3]) + vz[3]
+    zn = np.dot(near, vz[:3]) + vz[3]
+    zf = np.dot(far, vz[:3]) + vz[3]
+    if zn == zf:
+        return None
+    s = (zc - zn) / (zf - zn)
+    s0 = max(float(s.min()), 0.0)
+    s1 = min(float(s.max()), 1.0)
+    if s0 > s1:
+        return None
+    return (near + s0 * (far - near), near + s1 * (far - near),
+            rn + s0 * (rf - rn), rn + s1 * (rf - rn))
+
+
+def get_view_key(view):
+    """Get hashable key of view parameters."""
+    return (tuple(tuple(row) for row in view.perspective_matrix),
+            view.width, view.height)
+
+
+def get_edge_midpoints(arrays, edge_indices):
+    ev = arrays.edge_verts[edge_indices]
+    return (arrays.co[ev[:, 0]] + arrays.co[ev[:, 1]]) * 0.5
+
+
+def get_face_centroids(arrays, face_indices):
+    """Get centroids of faces by segment-sum over loop array."""
+    if len(face_indices) == 0:
+        return np.empty((0, 3), dtype=np.float32)
+    totals = arrays.face_loop_total[face_indices]
+    starts = arrays.face_loop_start[face_indices]
+    # gather loops of the faces into contiguous segments
+    seg_starts = np.zeros(len(totals), dtype=np.int64)
+    np.cumsum(totals[:-1], out=seg_starts[1:])
+    loops = np.repeat(starts - seg_starts, totals) + \
+        np.arange(int(totals.sum()))
+    sums = np.add.reduceat(arrays.co[arrays.loop_verts[loops]], seg_starts,
+                           axis=0)
+    return sums / totals[:, np.newaxis]
+
+
+def get_element_positions(arrays, kind):
+    """Get positions of all vertices, edge midpoints or face centroids."""
+    if kind == LABEL_VERT:
+        return arrays.co
+    if kind == LABEL_EDGE:
+        return get_edge_midpoints(arrays, np.arange(len(arrays.edge_verts)))
+    return get_face_centroids(arrays,
+                              np.arange(len(arrays.face_loop_start)))
+
+
+def get_label_kind(select_mode):
+    """Get kind of labels rendered in select mode."""
+    if "FACE" in select_mode:
+        return LABEL_FACE
+    if "EDGE" in select_mode:
+        return LABEL_EDGE
+    return LABEL_VERT
+
+
+def get_run_indices(starts, lengths):
+    """Get concatenated indices of runs [start, start + length)."""
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + \
+        np.arange(int(lengths.sum()))
+
+
+class PointGrid:
+    """Uniform grid index of 2D or 3D points for radius query.
+
+    Points are sorted by cell, so points in a cell are a contiguous run
+    found by binary search. Cell size is chosen from the bounding box so
+    that a cell has a few points on average."""
+
+    POINTS_PER_CELL = 8
+    # radius covering more cells than this is tested against all points
+    MAX_QUERY_CELLS = 4096
+
+    def __init__(self, points):
+        points = np.asarray(points, dtype=np.float32)
+        n, dim = points.shape
+        self.__points = points
+        self.__order = np.arange(n)
+        self.__keys = np.empty(0, dtype=np.int64)
+        self.__lo = np.zeros(dim, dtype=np.float32)
+        self.__cell = 1.0
+        self.__dims = np.ones(dim, dtype=np.int64)
+        self.bounds = None
+        if n == 0:
+            return
+
+        lo = points.min(axis=0)
+        self.bounds = (lo, points.max(axis=0))
+        extent = points.max(axis=0) - lo
+        # flat dimension would make cells too small
+        extent = np.maximum(extent, extent.max() * 1e-3 + 1e-9)
+        cell = float((np.prod(extent.astype(np.float64)) *
+                      self.POINTS_PER_CELL / n) ** (1.0 / dim))
+        dims = (extent // cell).astype(np.int64) + 1
+        c = np.minimum(((points - lo) // cell).astype(np.int64), dims - 1)
+        keys = np.ravel_multi_index(tuple(c.T), tuple(dims))
+
+        order = np.argsort(keys, kind='mergesort')
+        self.__points = points[order]
+        self.__order = order
+        self.__keys = keys[order]
+        self.__lo = lo
+        self.__cell = cell
+        self.__dims = dims
+
+    def query(self, center, radius):
+        """Get indices of points within radius from center."""
+        center = np.asarray(center, dtype=np.float32)
+        if len(self.__keys) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        c0 = np.floor((center - radius - self.__lo) / self.__cell)
+        c1 = np.floor((center + radius - self.__lo) / self.__cell)
+        if (c1 < 0).any() or (c0 >= self.__dims).any():
+            return np.empty(0, dtype=np.int64)
+        c0 = np.maximum(c0, 0).astype(np.int64)
+        c1 = np.minimum(c1, self.__dims - 1).astype(np.int64)
+
+        if np.prod(c1 - c0 + 1) > self.MAX_QUERY_CELLS:
+            candidates = np.arange(len(self.__keys))
+        else:
+            axes = np.meshgrid(*[np.arange(a, b + 1) for a, b in zip(c0, c1)],
+                               indexing='ij')
+            keys = np.ravel_multi_index(tuple(a.ravel() for a in axes),
+                                        tuple(self.__dims))
+            starts = np.searchsorted(self.__keys, keys, side='left')
+            lengths = np.searchsorted(self.__keys, keys, side='right') - \
+                starts
+            candidates = get_run_indices(starts, lengths)
+
+        d = self.__points[candidates] - center
+        inside = np.einsum('ij,ij->i', d, d) <= radius * radius
+        return self.__order[candidates[inside]]
+
+    def query_cone(self, a, b, ra, rb):
+        """Get indices of points in the cells around segment a-b, whose
+        radius changes linearly from ra at a to rb at b. Points are not
+        tested exactly, so some of them may be out of the cone. Return None
+        if the cone covers so many cells that testing all points is
+        cheaper."""
+        if len(self.__keys) == 0:
+            return np.empty(0, dtype=np.int64)
+        a = np.asarray(a, dtype=np.float64)
+        b = np.asarray(b, dtype=np.float64)
+        cell = self.__cell
+
+        # cubes around samples along the segment cover the cone
+        length = float(np.linalg.norm(b - a))
+        step = max(cell, min(ra, rb))
+        n = int(length // step) + 2
+        s = np.linspace(0.0, 1.0, n)
+        centers = a + s[:, np.newaxis] * (b - a)
+        radii = ra + s * (rb - ra)
+        half = np.maximum(radii, np.maximum(np.roll(radii, 1),
+                                            np.roll(radii, -1)))
+        half += length / (n - 1) * 0.5
+        c0 = np.floor((centers - half[:, np.newaxis] - self.__lo) / cell)
+        c1 = np.floor((centers + half[:, np.newaxis] - self.__lo) / cell)
+        inside = (c1 >= 0).all(axis=1) & (c0 < self.__dims).all(axis=1)
+        c0 = np.maximum(c0[inside], 0).astype(np.int64)
+        c1 = np.minimum(c1[inside], self.__dims - 1).astype(np.int64)
+
+        widths = c1 - c0 + 1
+        counts = np.prod(widths, axis=1)
+        if counts.sum() > len(self.__keys) // self.POINTS_PER_CELL:
+            return None
+        owners = np.repeat(np.arange(len(counts)), counts)
+        k = get_run_indices(np.zeros_like(counts), counts)
+        coords = []
+        for axis in range(len(self.__dims) - 1, -1, -1):
+            coords.append(c0[owners, axis] + k % widths[owners, axis])
+            k = k // widths[owners, axis]
+        keys = np.unique(np.ravel_multi_index(tuple(coords[::-1]),
+                                              tuple(self.__dims)))
+
+        starts = np.searchsorted(self.__keys, keys, side='left')
+        lengths = np.searchsorted(self.__keys, keys, side='right') - starts
+        return self.__order[get_run_indices(starts, lengths)]
+
+
+class UVFaceGrid:
+    """Coarse grid index over UV bounding boxes of faces, which finds the
+    labels of faces overlapping a rectangle in UV space.
+
+    A face is registered to every cell its bounding box overlaps, and the
+    labels are ordered by face so that labels of a face are a contiguous
+    run. A query costs in proportion to the faces in the rectangle rather
+    than to all faces."""
+
+    FACES_PER_CELL = 4
+    MAX_CELLS = 256
+
+    def __init__(self, arrays, uv, label_faces):
+        n_faces = len(arrays.face_loop_total)
+        label_faces = np.asarray(label_faces, dtype=np.int64)
+        self.__order = np.argsort(label_faces, kind='mergesort')
+        self.__label_starts = np.searchsorted(label_faces[self.__order],
+                                              np.arange(n_faces + 1))
+        self.__faces = np.flatnonzero(np.diff(self.__label_starts))
+        if len(self.__faces) == 0:
+            return
+
+        # only faces having labels are indexed
+        starts = arrays.face_loop_start
+        self.__face_lo = np.minimum.reduceat(uv, starts)
+        self.__face_hi = np.maximum.reduceat(uv, starts)
+        lo = self.__face_lo[self.__faces].min(axis=0)
+        hi = self.__face_hi[self.__faces].max(axis=0)
+        n = int(np.clip(np.sqrt(len(self.__faces) / self.FACES_PER_CELL),
+                        1, self.MAX_CELLS))
+        self.__lo = lo
+        self.__hi = hi
+        self.__cell = np.maximum(hi - lo, 1e-6) / n
+        self.__n = n
+
+        c0, c1 = self.__get_cell_range(self.__face_lo[self.__faces],
+                                       self.__face_hi[self.__faces])
+        widths = c1[:, 0] - c0[:, 0] + 1
+        counts = widths * (c1[:, 1] - c0[:, 1] + 1)
+        owners = np.repeat(np.arange(len(self.__faces)), counts)
+        k = get_run_indices(np.zeros_like(counts), counts)
+        keys = (c0[owners, 1] + k // widths[owners]) * n + \
+            c0[owners, 0] + k % widths[owners]
+        order = np.argsort(keys, kind='mergesort')
+        self.__cell_faces = self.__faces[owners[order]]
+        self.__cell_starts = np.searchsorted(keys[order], np.arange(n * n + 1))
+
+    def __get_cell_range(self, lo, hi):
+        c0 = np.floor((lo - self.__lo) / self.__cell).astype(np.int64)
+        c1 = np.floor((hi - self.__lo) / self.__cell).astype(np.int64)
+        return (np.clip(c0, 0, self.__n - 1), np.clip(c1, 0, self.__n - 1))
+
+    def query(self, lo, hi):
+        """Get sorted indices of labels of faces overlapping rectangle
+        lo-hi, or None if the rectangle contains all faces."""
+        if len(self.__faces) == 0:
+            return None
+        lo = np.asarray(lo, dtype=np.float32)
+        hi = np.asarray(hi, dtype=np.float32)
+        if (lo <= self.__lo).all() and (hi >= self.__hi).all():
+            return None
+        if (hi < self.__lo).any() or (lo > self.__hi).any():
+            return np.empty(0, dtype=np.int64)
+
+        c0, c1 = self.__get_cell_range(lo[np.newaxis], hi[np.newaxis])
+        xs = np.arange(c0[0, 0], c1[0, 0] + 1)
+        ys = np.arange(c0[0, 1], c1[0, 1] + 1)
+        keys = (ys[:, np.newaxis] * self.__n + xs).ravel()
+        starts = self.__cell_starts[keys]
+        faces = np.unique(self.__cell_faces[get_run_indices(
+            starts, self.__cell_starts[keys + 1] - starts)])
+        overlapped = (self.__face_lo[faces] <= hi).all(axis=1) & \
+            (self.__face_hi[faces] >= lo).all(axis=1)
+        faces = faces[overlapped]
+
+        starts = self.__label_starts[faces]
+        return np.sort(self.__order[get_run_indices(
+            starts, self.__label_starts[faces + 1] - starts)])
+
+
+class ElementGrid:
+    """Grid index over world positions of all elements of a kind,
+    including unselected ones. It is kept while geometry is not changed,
+    and region queries look up the cells around the ray through the query
+    center, so that changing view does not re-index elements."""
+
+    def __init__(self, snapshot, kind):
+        self.__arrays = snapshot.arrays
+        self.__world_mat = snapshot.world_mat
+        self.kind = kind
+        self.positions = transform_points(
+            snapshot.world_mat, get_element_positions(snapshot.arrays, kind))
+        self.__grid = PointGrid(self.positions)
+
+    def has_same_geometry(self, snapshot, kind):
+        a = self.__arrays
+        b = snapshot.arrays
+        if kind != self.kind or \
+           not np.array_equal(self.__world_mat, snapshot.world_mat):
+            return False
+        return all(np.array_equal(getattr(a, f), getattr(b, f))
+                   for f in ("co", "edge_verts", "loop_verts",
+                             "face_loop_start"))
+
+    def query_world(self, center, radius):
+        return self.__grid.query(center, radius)
+
+    def query_region(self, view, center, radius):
+        """Get indices of elements within radius pixels from center on
+        region. Only the elements around the ray through center are
+        projected."""
+        bounds = self.__grid.bounds
+        cone = None if bounds is None \
+            else get_pick_cone(view, center, radius, *bounds)
+        if cone is None:
+            return np.empty(0, dtype=np.int64)
+        candidates = self.__grid.query_cone(*cone)
+        if candidates is None:
+            candidates = np.arange(len(self.positions))
+        screen, visible = project_points(view, self.positions[candidates])
+        d = screen - np.asarray(center, dtype=np.float32)
+        inside = visible & \
+            (np.einsum('ij,ij->i', d, d) <= radius * radius)
+        return candidates[inside]
+
+
+def read_uv_arrays(obj, bm, uv_layer):
+    """Read UV coordinates and UV selection flags of loops into NumPy arrays.
+
+    read_mesh_arrays must be called before, so that mesh data is synced with
+    edit mesh."""
+    if not hasattr(obj, "update_from_editmode"):
+        luvs = [l[uv_layer] for f in bm.faces for l in f.loops]
+        uv = np.array([luv.uv for luv in luvs],
+                      dtype=np.float32).reshape(-1, 2)
+        uv_sel = np.fromiter((luv.select for luv in luvs), np.bool_,
+                             len(luvs))
+        return (uv, uv_sel)
+
+    data = obj.data.uv_layers.active.data
+    return (foreach_get_array(data, "uv", np.float32, 2),
+            foreach_get_array(data, "select", np.bool_))
+
+
+def get_next_loops(arrays):
+    """Get index of the next loop in the face for each loop."""
+    starts = arrays.face_loop_start
+    totals = arrays.face_loop_total
+    loop_next = np.arange(1, int(totals.sum()) + 1, dtype=np.int32)
+    loop_next[starts + totals - 1] = starts
+    return loop_next
+
+
+def get_uv_loop_geometry(uv, loop_next):
+    """Get midpoints, unit tangents and unit normals of UV edges from each
+    loop to its next loop."""
+    uv2 = uv[loop_next]
+    mid = (uv + uv2) * 0.5
+    tangents = uv2 - uv
+    length = np.sqrt((tangents * tangents).sum(axis=1))
+    degenerated = length == 0.0
+    tangents /= np.where(degenerated, 1.0, length)[:, np.newaxis]
+    tangents[degenerated] = (1.0, 0.0)
+    normals = np.empty_like(tangents)
+    normals[:, 0] = -tangents[:, 1]
+    normals[:, 1] = tangents[:, 0]
+    return (mid, tangents, normals)
+
+
+def get_uv_face_centroids(arrays, uv):
+    """Get centroids of faces in UV space."""
+    uvc = np.add.reduceat(uv, arrays.face_loop_start, axis=0)
+    return uvc / arrays.face_loop_total[:, np.newaxis]
+
+
+def get_uv_element_positions(arrays, uv, kind):
+    """Get indices and UV positions of all labels of a kind, where vert and
+    edge labels are placed per loop as in UV Editor."""
+    if kind == LABEL_FACE:
+        return (np.arange(len(arrays.face_loop_start)),
+                get_uv_face_centroids(arrays, uv))
+    if kind == LABEL_VERT:
+        return (arrays.loop_verts, uv)
+    mid, _, _ = get_uv_loop_geometry(uv, get_next_loops(arrays))
+    if kind == LABEL_EDGE:
+        return (arrays.loop_edges, mid)
+    return (np.arange(len(uv)), mid)
+
+
+def get_view2d_transform(view2d):
+    """Get scale and offset which maps view coordinates to region."""
+    x0, y0 = view2d.view_to_region(0.0, 0.0, clip=False)
+    x1, y1 = view2d.view_to_region(100.0, 100.0, clip=False)
+    scale = np.array([(x1 - x0) / 100.0, (y1 - y0) / 100.0], dtype=np.float32)
+    offset = np.array([x0, y0], dtype=np.float32)
+    return (scale, offset)
+
+
+def get_unique_labels(indices, kinds, screen, tolerance):
+    """Get mask of labels to be kept, dropping labels which have the same
+    index and kind as a former label within tolerance on screen.
+
+    Labels are grouped by hash of index, kind and tolerance-sized cell of
+    screen position. Labels with equal hash are adjacent after stable sort
+    and compared exactly, so hash collision never merges labels."""
+    keep = np.ones(len(indices), dtype=bool)
+    if len(indices) < 2:
+        return keep
+    element = kinds.astype(np.int64) << 32 | indices
+    cells = np.floor(screen / tolerance).astype(np.int64)
+    with np.errstate(over='ignore'):
+        hashes = element * 0x9E3779B1 ^ cells[:, 0] * 0x85EBCA77 ^ \
+            cells[:, 1] * 0xC2B2AE3D
+    # stable sort keeps the former label first in its group
+    order = np.argsort(hashes, kind='mergesort')
+    element = element[order]
+    cells = cells[order]
+    same = (element[1:] == element[:-1]) & \
+        (cells[1:] == cells[:-1]).all(axis=1)
+    keep[order[1:][same]] = False
+    return keep
+
+
+def place_uv_labels(positions, tangents, normals, widths, heights,
+                    sub_offsets):
+    """Get text origins and angles of the labels placed along tangents."""
+    offset = (widths[:, np.newaxis] * tangents +
+              heights[:, np.newaxis] * normals) * 0.5
+    sub_offset = (sub_offsets * heights)[:, np.newaxis] * normals
+
+    # same as Vector.angle_signed against (1, 0) and (1, -1)
+    tx = tangents[:, 0]
+    ty = tangents[:, 1]
+    angles = np.arctan2(ty, tx)
+    cross = tx + ty
+    dot = tx - ty
+    backward = (cross > 0.0) | ((cross == 0.0) & (dot < 0.0))
+
+    origins = np.where(backward[:, np.newaxis],
+                       positions - offset + sub_offset,
+                       positions + offset + sub_offset)
+    angles = np.where(backward, angles, angles - pi)
+    return (origins, angles)
+
+
+def get_rotated_box_quads(origins, widths, heights, ch_counts, angles):
+    """Get Nx4x2 quads of background boxes rotated around text origins."""
+    font_w = widths / ch_counts
+    a = 0.6
+    x1 = -font_w / 2
+    y1 = -heights / 2 * a
+    x2 = x1 + widths + font_w
+    y2 = y1 + heights * (1 + a)
+    local = np.stack([x1, y1, x1, y2, x2, y2, x2, y1],
+                     axis=1).reshape(-1, 4, 2)
+
+    cos = np.cos(angles)[:, np.newaxis]
+    sin = np.sin(angles)[:, np.newaxis]
+    quads = np.empty_like(local)
+    quads[:, :, 0] = cos * local[:, :, 0] - sin * local[:, :, 1]
+    quads[:, :, 1] = sin * local[:, :, 0] + cos * local[:, :, 1]
+    return quads + origins[:, np.newaxis, :]
 
 
 class RenderUVIndexProperties(bpy.types.PropertyGroup):
@@ -86,12 +1974,38 @@ class IVRenderer(bpy.types.Operator):
 
     __handle = None
     __timer = None
+    __snapshots = {}
+    __collected = {}
+    __merged = SnapshotCache()
+    __merge_buffer = LabelBuffer()
+    __hierarchy = SnapshotCache()
+    __grids = {}
+    __mouse = None
+    # region -> [view key, time when view is changed, throttled]
+    __views = {}
+    # region -> RegionCache
+    __regions = {}
+    # areas where indices are rendered
+    __areas = set()
+    __executor = None
+    __occlusion = OcclusionTester()
+    __glyphs = GlyphAtlas()
+    __layers = LayerCache()
+
+    profiler = FrameProfiler("view3d")
 
     @staticmethod
     def handle_add(self, context):
         IVRenderer.__handle = bpy.types.SpaceView3D.draw_handler_add(
             IVRenderer.render_indices,
             (self, context), 'WINDOW', 'POST_PIXEL')
+        IVRenderer.__timer = context.window_manager.event_timer_add(
+            0.05, context.window)
+        IVRenderer.__snapshots.clear()
+        if IVRenderer.__on_scene_update not in \
+                bpy.app.handlers.scene_update_post:
+            bpy.app.handlers.scene_update_post.append(
+                IVRenderer.__on_scene_update)
 
     @staticmethod
     def handle_remove(self, context):
@@ -99,127 +2013,645 @@ class IVRenderer(bpy.types.Operator):
             bpy.types.SpaceView3D.draw_handler_remove(
                 IVRenderer.__handle, 'WINDOW')
             IVRenderer.__handle = None
+        if IVRenderer.__timer is not None:
+            context.window_manager.event_timer_remove(IVRenderer.__timer)
+            IVRenderer.__timer = None
+        if IVRenderer.__on_scene_update in bpy.app.handlers.scene_update_post:
+            bpy.app.handlers.scene_update_post.remove(
+                IVRenderer.__on_scene_update)
+        for cache in IVRenderer.__regions.values():
+            cache.worker.shutdown()
+        if IVRenderer.__executor is not None:
+            IVRenderer.__executor.shutdown(wait=True)
+            IVRenderer.__executor = None
+        IVRenderer.__snapshots.clear()
+        IVRenderer.__collected = {}
+        IVRenderer.__grids = {}
+        IVRenderer.__views.clear()
+        IVRenderer.__regions.clear()
+        IVRenderer.__areas.clear()
+        IVRenderer.__glyphs.free()
+        IVRenderer.__layers.free()
+
+    @staticmethod
+    def enable_area(area):
+        """Render indices in area."""
+        IVRenderer.__areas.add(area.as_pointer())
+
+    @staticmethod
+    def disable_area(area):
+        """Stop rendering indices in area, and free its regions' caches."""
+        IVRenderer.__areas.discard(area.as_pointer())
+        for region in area.regions:
+            cache = IVRenderer.__regions.pop(region.as_pointer(), None)
+            if cache is not None:
+                cache.worker.shutdown()
+                IVRenderer.__layers.discard(region)
+            IVRenderer.__views.pop(region.as_pointer(), None)
+
+    @staticmethod
+    def is_enabled(area):
+        return area.as_pointer() in IVRenderer.__areas
+
+    @staticmethod
+    def has_areas():
+        return len(IVRenderer.__areas) > 0
+
+    @staticmethod
+    def get_region_cache(region=None):
+        """Get labels cached for region. Worker jobs of all regions run on
+        one thread, since they share collected labels."""
+        ptr = 0 if region is None else region.as_pointer()
+        cache = IVRenderer.__regions.get(ptr)
+        if cache is None:
+            if IVRenderer.__executor is None:
+                IVRenderer.__executor = ThreadPoolExecutor(max_workers=1)
+            cache = IVRenderer.__regions[ptr] = \
+                RegionCache(IVRenderer.__executor)
+        return cache
+
+    @staticmethod
+    def __tag_redraw(context):
+        for area in context.screen.areas:
+            if IVRenderer.is_enabled(area):
+                area.tag_redraw()
+
+    @staticmethod
+    def __on_scene_update(scene):
+        # mesh data is tagged as updated when it is edited (ex. transform)
+        snapshots = IVRenderer.__snapshots
+        for obj in scene.objects:
+            if obj.mode != 'EDIT':
+                continue
+            if obj.is_updated or obj.is_updated_data:
+                snapshot = snapshots.get(obj.as_pointer())
+                if snapshot is not None:
+                    snapshot.invalidate()
+                IVRenderer.__occlusion.invalidate()
 
     @classmethod
     def is_running(self):
         return IVRenderer.__handle is not None
 
     @staticmethod
-    def __render_data(context, data):
-        for d in data:
-            IVRenderer.__render_each_data(context, d)
+    def track_mouse(context, event):
+        """Remember mouse position for near cursor mode."""
+        IVRenderer.__mouse = (event.mouse_x, event.mouse_y)
+        sc = context.scene
+        if sc.iv_near_cursor and sc.iv_near_source == 'MOUSE':
+            IVRenderer.__tag_redraw(context)
 
     @staticmethod
-    def __render_each_data(context, data):
+    def settle(context):
+        """Redraw views which were throttled and have been still for settle
+        time, so that full layout is rendered."""
         sc = context.scene
-        # setup rendering region
-        area = context.area
-        if area.type != "VIEW_3D":
-            return
-        for region in area.regions:
-            if region.type == "WINDOW":
-                break
+        now = time.perf_counter()
+        settled = False
+        for state in IVRenderer.__views.values():
+            if state[2] and now - state[1] >= sc.iv_settle_time:
+                state[2] = False
+                settled = True
+        if settled:
+            IVRenderer.__tag_redraw(context)
+
+    @staticmethod
+    def __is_navigating(region, view, settings):
+        """Check if view of region was changed within settle time."""
+        key = get_view_key(view)
+        now = time.perf_counter()
+        state = IVRenderer.__views.get(region.as_pointer())
+        if state is None:
+            state = IVRenderer.__views[region.as_pointer()] = \
+                [key, now - settings.settle_time, False]
+        if state[0] != key:
+            state[0] = key
+            state[1] = now
+        state[2] = now - state[1] < settings.settle_time
+        return state[2]
+
+    @staticmethod
+    def get_near_query(context):
+        """Get query of near cursor mode, or None if it is disabled."""
+        sc = context.scene
+        if not sc.iv_near_cursor:
+            return None
+        if sc.iv_near_source == 'CURSOR':
+            return NearQuery('CURSOR', tuple(sc.cursor_location),
+                             sc.iv_near_radius)
+        region = context.region
+        mouse = IVRenderer.__mouse
+        if mouse is None:
+            center = (region.width / 2.0, region.height / 2.0)
         else:
-            return
-        for space in area.spaces:
-            if space.type == "VIEW_3D":
+            center = (mouse[0] - region.x, mouse[1] - region.y)
+        return NearQuery('MOUSE', center, sc.iv_near_pixels)
+
+    @staticmethod
+    def get_frame_settings(context):
+        """Get settings which are invariant during a frame."""
+        sc = context.scene
+        return FrameSettings(
+            font_size=sc.iv_font_size,
+            box_color=tuple(sc.iv_box_color),
+            text_color=tuple(sc.iv_text_color),
+            max_labels=sc.iv_max_labels,
+            hide_overlapped=sc.iv_hide_overlapped,
+            visible_only=sc.iv_visible_only,
+            use_worker=sc.iv_use_worker,
+            lod=sc.iv_lod,
+            near=IVRenderer.get_near_query(context),
+            adaptive=sc.iv_adaptive,
+            nav_labels=sc.iv_nav_labels,
+            settle_time=sc.iv_settle_time,
+            cache_layer=sc.iv_cache_layer,
+            time_budget=sc.iv_time_budget / 1000.0 if sc.iv_progressive
+            else 0.0,
+            all_kinds=sc.iv_all_kinds,
+            kind_colors=(tuple(sc.iv_vert_color), tuple(sc.iv_edge_color),
+                         tuple(sc.iv_text_color), tuple(sc.iv_face_color))
+            if sc.iv_all_kinds else None
+        )
+
+    @staticmethod
+    def get_edit_objects(context):
+        """Get (object, bmesh) pairs of mesh objects in edit mode."""
+        objects = [obj for obj in context.visible_objects
+                   if obj.type == 'MESH' and obj.mode == 'EDIT']
+        active = context.active_object
+        if active not in objects:
+            objects.append(active)
+        return [(obj, bmesh.from_edit_mesh(obj.data)) for obj in objects]
+
+    @staticmethod
+    def merge(collected, out=None):
+        """Merge labels collected from objects into one buffer out, which
+        is reused on the next merge."""
+        if len(collected) == 1:
+            return collected[0]
+        if out is None:
+            out = IVRenderer.__merge_buffer
+        return out.concatenate(collected)
+
+    @staticmethod
+    def read(obj, bm):
+        """Read mesh data into plain arrays. This must run on main
+        thread."""
+        return MeshSnapshot(
+            arrays=read_mesh_arrays(obj, bm),
+            select_mode=frozenset(bm.select_mode),
+            world_mat=np.array(obj.matrix_world, dtype=np.float32)
+        )
+
+    @staticmethod
+    def collect(snapshot, all_kinds=False):
+        """Collect indices and world positions of selected elements. If
+        all_kinds is True, selected verts, edges and faces are collected
+        together."""
+        selected = IVRenderer.__get_selected(snapshot, all_kinds)
+        # vertex coordinates are transformed once and shared by edge
+        # midpoints and face centroids
+        world_co = None
+        if len(selected) > 1:
+            world_co = transform_points(snapshot.world_mat,
+                                        snapshot.arrays.co)
+        buf = LabelBuffer()
+        buf.resize(sum(len(indices) for _, indices in selected))
+        offset = 0
+        for kind, indices in selected:
+            buf.fill(indices,
+                     IVRenderer.__get_positions(snapshot, kind, indices,
+                                                world_co),
+                     kind, offset=offset)
+            offset += len(indices)
+        return buf
+
+    @staticmethod
+    def iter_prepare(sources, view, settings, chunk=PROGRESSIVE_CHUNK):
+        """Generator version of prepare for huge selections. Labels are
+        collected, projected and laid out chunk by chunk, and partial
+        LayoutData is yielded with progress after each chunk."""
+        # labels accepted in former chunks are kept in the grid
+        grid = CoverageMap()
+        selected = [(snapshot, kind, indices)
+                    for _, snapshot in sources
+                    for kind, indices in IVRenderer.__get_selected(
+                        snapshot, settings.all_kinds)]
+        total = max(sum(len(indices) for _, _, indices in selected), 1)
+        done = 0
+        layouts = LayoutBuilder()
+        remaining = settings.max_labels
+        # chunks are copied to the next stage, so the buffer is reused
+        buf = LabelBuffer()
+        for snapshot, kind, indices in selected:
+            start = 0
+            while start < len(indices):
+                part = indices[start:start + chunk]
+                start += len(part)
+                collected = LabelBuffer.from_arrays(
+                    part, IVRenderer.__get_positions(snapshot, kind, part),
+                    kind, buf)
+                projected = IVRenderer.project(view, collected)
+                layout = IVRenderer.layout(
+                    settings._replace(max_labels=remaining), view,
+                    projected, grid)
+                layouts.append(layout)
+                remaining -= len(layout.indices)
+                done += len(part)
+                if remaining <= 0:
+                    break
+                chunk = (yield (done / total, layouts.get())) or chunk
+            if remaining <= 0:
                 break
+        yield (1.0, layouts.get())
+
+    @staticmethod
+    def collect_near(version, snapshot, view, near, all_kinds=False):
+        """Collect indices and world positions of all elements near the
+        cursor, including unselected ones."""
+        if all_kinds:
+            kinds = (LABEL_VERT, LABEL_EDGE, LABEL_FACE)
+        else:
+            kinds = (get_label_kind(snapshot.select_mode),)
+        grids = IVRenderer.__grids
+        parts = []
+        for kind in kinds:
+            grid = grids.get((version, kind))
+            if grid is None:
+                # reuse grid if only selection is changed
+                for g in grids.values():
+                    if g.has_same_geometry(snapshot, kind):
+                        grid = g
+                        break
+                else:
+                    grid = ElementGrid(snapshot, kind)
+                grids[(version, kind)] = grid
+
+            if near.source == 'CURSOR':
+                indices = grid.query_world(near.center, near.radius)
+            else:
+                indices = grid.query_region(view, near.center, near.radius)
+            indices.sort()
+            parts.append(LabelBuffer.from_arrays(
+                indices, grid.positions[indices], kind))
+        return parts[0] if len(parts) == 1 \
+            else LabelBuffer().concatenate(parts)
+
+    @staticmethod
+    def project(view, collected, last=None):
+        """Project collected positions to region and drop the ones behind
+        the viewer. last is the last indices of clustered labels."""
+        _, visible = project_points(view, collected.positions,
+                                    collected.screen)
+        projected = collected.select(visible)
+        projected.last = None if last is None else last[visible]
+        return projected
+
+    @staticmethod
+    def get_label_canvases(settings, screen, indices, last, kinds):
+        """Get canvases of labels, shifted by kind if all kinds of labels
+        are rendered."""
+        if settings.all_kinds:
+            screen = screen + KIND_OFFSETS[kinds] * (settings.font_size * 1.5)
+        return get_canvases(screen, get_label_lengths(indices, last),
+                            settings.font_size)
+
+    @staticmethod
+    def layout(settings, view, projected, grid=None):
+        """Decide labels to be rendered and their canvases."""
+        indices = projected.indices
+        last = projected.last
+        rects = IVRenderer.get_label_canvases(settings, projected.screen,
+                                              indices, last, projected.kinds)
+
+        # hide labels occluded by geometry, tested after screen culling
+        depth = is_visible = None
+        if settings.visible_only:
+            depth, is_visible = IVRenderer.__occlusion.get_visibility_func(
+                view, projected.positions)
+
+        # cull labels out of region and overlapped labels
+        rendered = layout_labels(rects, view.width, view.height,
+                                 settings.max_labels,
+                                 settings.hide_overlapped,
+                                 depth, is_visible, grid)
+        return LayoutData(indices=indices[rendered], rects=rects[rendered],
+                          last=None if last is None else last[rendered],
+                          positions=projected.positions[rendered],
+                          kinds=projected.kinds[rendered])
+
+    @staticmethod
+    def reproject(settings, view, layout):
+        """Move labels laid out on other view to the view, and keep the ones
+        nearest to region center. This is much cheaper than layout, so it
+        is used while view is being changed."""
+        screen, visible = project_points(view, layout.positions)
+        d = screen - (view.width / 2.0, view.height / 2.0)
+        dist = np.where(visible, np.einsum('ij,ij->i', d, d), np.inf)
+        order = np.argsort(dist, kind='mergesort')[:settings.nav_labels]
+        order = order[np.isfinite(dist[order])]
+
+        indices = layout.indices[order]
+        last = None if layout.last is None else layout.last[order]
+        kinds = layout.kinds[order]
+        rects = IVRenderer.get_label_canvases(settings, screen[order],
+                                              indices, last, kinds)
+        return LayoutData(indices=indices, rects=rects, last=last,
+                          positions=layout.positions[order], kinds=kinds)
+
+    @staticmethod
+    def prepare(sources, view, settings, rec=NULL_RECORD, cache=None):
+        """Run collect -> project -> layout stages for (version, snapshot)
+        pairs of objects. Output of each stage is cached while its input is
+        not changed, collected labels for all regions and the others in
+        RegionCache cache of the region. This does not access Blender data,
+        so it can run on worker thread."""
+        if cache is None:
+            cache = IVRenderer.get_region_cache()
+        rec.mark()
+        versions = tuple(v for v, _ in sources)
+        if settings.near is None:
+            collected = {}
+            for version, snapshot in sources:
+                key = (version, settings.all_kinds)
+                data = IVRenderer.__collected.get(key)
+                rec.hit("collect", data is not None)
+                if data is None:
+                    data = IVRenderer.collect(snapshot, settings.all_kinds)
+                collected[key] = data
+            IVRenderer.__collected = collected
+            merged_key = (versions, settings.all_kinds)
         else:
+            # labels near cursor are queried again when cursor or view is
+            # changed
+            merged_key = (versions, settings.all_kinds, settings.near,
+                          get_view_key(view))
+
+        # merge all objects' data into one projection and draw pass
+        if settings.near is None:
+            merged = IVRenderer.__merged
+            if not merged.is_valid(merged_key):
+                parts = [collected[(v, settings.all_kinds)] for v in versions]
+                merged.update(merged_key, IVRenderer.merge(parts))
+        else:
+            merged = cache.merged
+            if not merged.is_valid(merged_key):
+                parts = [IVRenderer.collect_near(v, snapshot, view,
+                                                 settings.near,
+                                                 settings.all_kinds)
+                         for v, snapshot in sources]
+                merged.update(merged_key,
+                              IVRenderer.merge(parts, cache.merge_buffer))
+            # grids are kept while geometry is not changed, so grids of
+            # former versions are dropped after they are looked up
+            IVRenderer.__grids = {k: g for k, g in IVRenderer.__grids.items()
+                                  if k[0] in versions}
+        rec.lap("collect")
+        rec.count("collected", len(merged.data.indices))
+
+        # when zoomed out, render clusters of labels picked from hierarchy
+        # built once per collected data
+        source, last, level = merged.data, None, None
+        if settings.lod:
+            hierarchy = IVRenderer.__hierarchy
+            rec.hit("cluster", hierarchy.is_valid(merged.version))
+            if not hierarchy.is_valid(merged.version):
+                hierarchy.update(merged.version,
+                                 LabelHierarchy(merged.data.indices,
+                                                merged.data.positions,
+                                                merged.data.kinds))
+            level = hierarchy.data.pick_level(
+                view, settings.font_size * LabelHierarchy.CELL_CHARS)
+            if level is not None:
+                source, last = hierarchy.data.get_clusters(level)
+            rec.lap("cluster")
+
+        # re-project only when view or collected data is changed
+        projected = cache.projected
+        proj_key = (merged.version, level, get_view_key(view))
+        rec.hit("project", projected.is_valid(proj_key))
+        if not projected.is_valid(proj_key):
+            projected.update(proj_key,
+                             IVRenderer.project(view, source, last))
+        rec.lap("project")
+        rec.count("projected", len(projected.data.indices))
+
+        # re-layout only when projection or layout settings are changed
+        layout = cache.layout
+        layout_key = (proj_key, settings.font_size, settings.max_labels,
+                      settings.hide_overlapped, settings.visible_only)
+        rec.hit("layout", layout.is_valid(layout_key))
+        if not layout.is_valid(layout_key):
+            layout.update(layout_key, IVRenderer.layout(settings, view,
+                                                        projected.data))
+        rec.lap("layout")
+        rec.count("drawn", len(layout.data.indices))
+
+        return layout.data
+
+    @staticmethod
+    def __prepare_job(sources, view, settings, cache):
+        rec = IVRenderer.profiler.begin("worker")
+        layout = IVRenderer.prepare(sources, view, settings, rec, cache)
+        rec.end()
+        return layout
+
+    @staticmethod
+    def draw(settings, layout):
+        """Render boxes and indices of laid out labels."""
+        # render boxes
+        batch = QuadBatch()
+        batch.add(get_rect_quads(layout.rects), settings.box_color)
+        batch.draw()
+
+        # render indices with glyph atlas if possible
+        glyphs = IVRenderer.__glyphs
+        if GlyphAtlas.is_supported() and glyphs.ensure(settings.font_size):
+            rects = layout.rects
+            origins = np.empty((len(rects), 2), dtype=np.float32)
+            origins[:, 0] = rects[:, 0] + (rects[:, 2] - rects[:, 0]) * 0.18
+            origins[:, 1] = rects[:, 1] + (rects[:, 3] - rects[:, 1]) * 0.24
+            if settings.kind_colors is None:
+                glyphs.draw(layout.indices, origins, settings.text_color,
+                            layout.last)
+                return
+            # one draw call per kind
+            for kind in np.unique(layout.kinds).tolist():
+                mask = layout.kinds == kind
+                glyphs.draw(layout.indices[mask], origins[mask],
+                            settings.kind_colors[kind],
+                            None if layout.last is None
+                            else layout.last[mask])
             return
-        loc_on_screen = view3d_utils.location_3d_to_region_2d(
-            region,
-            space.region_3d,
-            data[1])
-
-        rect = get_canvas(context, loc_on_screen, len(str(data[0])),
-                          sc.iv_font_size)
-        positions = [
-            [rect.x0, rect.y0],
-            [rect.x0, rect.y1],
-            [rect.x1, rect.y1],
-            [rect.x1, rect.y0]
-            ]
-
-        # render box
-        bgl.glEnable(bgl.GL_BLEND)
-        bgl.glBegin(bgl.GL_QUADS)
-        box_color_r, box_color_g, box_color_b, box_color_a = sc.iv_box_color
-        bgl.glColor4f(box_color_r, box_color_g, box_color_b, box_color_a)
-        for (v1, v2) in positions:
-            bgl.glVertex2f(v1, v2)
-        bgl.glEnd()
 
-        # render index
-        font_size = sc.iv_font_size
-        blf.size(0, font_size, 72)
+        blf.size(0, settings.font_size, 72)
         blf.enable(0, blf.SHADOW)
         blf.shadow_offset(0, 1, -1)
         blf.shadow(0, 5, 0.0, 0.0, 0.0, 0.0)
-        blf.position(0, rect.x0 + (rect.x1 - rect.x0) * 0.18,
-                     rect.y0 + (rect.y1 - rect.y0) * 0.24, 0)
-        text_color_r, text_color_g, text_color_b, text_color_a = sc.iv_text_color
-        bgl.glColor4f(text_color_r, text_color_g, text_color_b, text_color_a)
-        blf.draw(0, str(data[0]))
+        bgl.glColor4f(*settings.text_color)
+        last = layout.indices if layout.last is None else layout.last
+        colors = settings.kind_colors
+        for index, l, kind, (x0, y0, x1, y1) in zip(layout.indices.tolist(),
+                                                    last.tolist(),
+                                                    layout.kinds.tolist(),
+                                                    layout.rects.tolist()):
+            if colors is not None:
+                bgl.glColor4f(*colors[kind])
+            blf.position(0, x0 + (x1 - x0) * 0.18, y0 + (y1 - y0) * 0.24, 0)
+            blf.draw(0, get_label_text(index, l))
         blf.blur(0, 0)
         blf.disable(0, blf.SHADOW)
 
     @staticmethod
-    def __get_rendered_face(context, bm, world_mat):
-        rendered_object = []
-        for face in bm.faces:
-            if face.select:
-                ave = mathutils.Vector((0.0, 0.0, 0.0))
-                for v in face.verts:
-                    ave = ave + v.co
-                ave = ave / len(face.verts)
-                rendered_object.append((face.index, world_mat * ave))
-        return rendered_object
-
-    @staticmethod
-    def __get_rendered_edge(context, bm, world_mat):
-        rendered_object = []
-        for edge in bm.edges:
-            if edge.select:
-                ave = mathutils.Vector((0.0, 0.0, 0.0))
-                for v in edge.verts:
-                    ave = ave + v.co
-                ave = ave / len(edge.verts)
-                rendered_object.append((edge.index, world_mat * ave))
-        return rendered_object
+    def __get_selected(snapshot, all_kinds=False):
+        """Get (kind, indices of selected elements) pairs of labels."""
+        arrays = snapshot.arrays
+        if all_kinds:
+            kinds = (LABEL_VERT, LABEL_EDGE, LABEL_FACE)
+        else:
+            kinds = (get_label_kind(snapshot.select_mode),)
+        sel = {LABEL_VERT: arrays.vert_sel, LABEL_EDGE: arrays.edge_sel,
+               LABEL_FACE: arrays.face_sel}
+        return [(kind, np.flatnonzero(sel[kind])) for kind in kinds]
 
     @staticmethod
-    def __get_rendered_vert(context, bm, world_mat):
-        rendered_object = []
-        for vert in bm.verts:
-            if vert.select:
-                rendered_object.append((vert.index, world_mat * vert.co))
-        return rendered_object
+    def __get_positions(snapshot, kind, indices, world_co=None):
+        """Get world positions of elements. If world_co is given, it is
+        used as world positions of vertices."""
+        arrays = snapshot.arrays
+        if world_co is not None:
+            arrays = arrays._replace(co=world_co)
+        if kind == LABEL_FACE:
+            co = get_face_centroids(arrays, indices)
+        elif kind == LABEL_EDGE:
+            co = get_edge_midpoints(arrays, indices)
+        else:
+            co = arrays.co[indices]
+        if world_co is not None:
+            return co.astype(np.float32)
+        return transform_points(snapshot.world_mat, co)
 
     @staticmethod
     def render_indices(self, context):
-        wm = context.window_manager
-        sc = context.scene
-
+        """Render indices through the stages, read -> collect -> project ->
+        layout -> draw. Mesh is read on main thread, and the stages except
+        draw can run on worker thread."""
         if not IVRenderer.is_valid_context(context):
             return
 
-        # get rendered object
-        obj = bpy.context.active_object
-        world_mat = obj.matrix_world
-        bm = bmesh.from_edit_mesh(obj.data)
-        sel_mode = bm.select_mode
-        rendered_data = None
-        if "VERT" in sel_mode:
-            rendered_data = IVRenderer.__get_rendered_vert(context,
-                                                           bm, world_mat)
-        if "EDGE" in sel_mode:
-            rendered_data = IVRenderer.__get_rendered_edge(context,
-                                                           bm, world_mat)
-        if "FACE" in sel_mode:
-            rendered_data = IVRenderer.__get_rendered_face(context,
-                                                           bm, world_mat)
-
-        IVRenderer.__render_data(context, rendered_data)
+        # setup rendering region
+        area = context.area
+        if area.type != "VIEW_3D" or not IVRenderer.is_enabled(area):
+            return
+        # handler is called for each region of quad view
+        region = context.region
+        rv3d = context.region_data
+        if (region is None) or (region.type != "WINDOW") or (rv3d is None):
+            return
+
+        # get rendered objects
+        # profiling state is read from scene in each frame, since it is
+        # saved in .blend file without calling update of the property
+        IVRenderer.profiler.set_enabled(context.scene.iv_profile)
+        rec = IVRenderer.profiler.begin()
+        objects = IVRenderer.get_edit_objects(context)
+        settings = IVRenderer.get_frame_settings(context)
+
+        # re-read each object only when its mesh, selection or matrix is
+        # changed
+        snapshots = IVRenderer.__snapshots
+        sources = []
+        for obj, bm in objects:
+            ptr = obj.as_pointer()
+            snapshot = snapshots.get(ptr)
+            if snapshot is None:
+                snapshot = snapshots[ptr] = SnapshotCache()
+            signature = get_change_signature(context, obj, bm)
+            rec.hit("read", snapshot.is_valid(signature))
+            if not snapshot.is_valid(signature):
+                snapshot.update(signature, IVRenderer.read(obj, bm))
+            sources.append((snapshot.version, snapshot.data))
+        alive = set(obj.as_pointer() for obj, _ in objects)
+        for ptr in set(snapshots.keys()) - alive:
+            del snapshots[ptr]
+
+        view = get_view_params(region, rv3d)
+        cache = IVRenderer.get_region_cache(region)
+
+        # while view is being changed, move the last labels instead of
+        # laying out all labels again
+        if settings.adaptive and cache.drawn is not None and \
+                IVRenderer.__is_navigating(region, view, settings):
+            layout = IVRenderer.reproject(settings, view, cache.drawn)
+            rec.lap("reproject")
+            rec.count("drawn", len(layout.indices))
+            IVRenderer.draw(settings, layout)
+            rec.lap("draw")
+            rec.end()
+            return
+
+        if settings.visible_only:
+            IVRenderer.__occlusion.update(objects)
+        rec.lap("read")
+
+        worker = cache.worker
+        key = (tuple(v for v, _ in sources), get_view_key(view),
+               settings.font_size, settings.max_labels,
+               settings.hide_overlapped, settings.visible_only,
+               settings.lod, settings.near, settings.all_kinds)
+        task = None
+        if settings.time_budget > 0.0 and settings.near is None and \
+                not settings.lod:
+            # process labels chunk by chunk over redraws, and render
+            # partial results
+            worker.wait()
+            task = cache.task
+            if task is None or task.key != key:
+                task = cache.task = ProgressiveTask(
+                    key, IVRenderer.iter_prepare(sources, view, settings),
+                    PROGRESSIVE_CHUNK)
+            task.run(settings.time_budget)
+            rec.lap("prepare")
+            if not task.done:
+                area.tag_redraw()
+            layout = task.result
+        elif settings.use_worker:
+            # render the last completed labels while the next ones are
+            # prepared on worker thread
+            worker.poll()
+            worker.request(key, IVRenderer.__prepare_job, sources, view,
+                           settings, cache)
+            if worker.is_busy():
+                area.tag_redraw()
+            layout = worker.front
+            if layout is None:
+                rec.end()
+                return
+        else:
+            worker.wait()
+            layout = IVRenderer.prepare(sources, view, settings, rec, cache)
+
+        rec.mark()
+        if settings.cache_layer and LayerCache.is_supported():
+            # glyphs are rasterized to their own offscreen, so it must be
+            # done out of the layer
+            IVRenderer.__glyphs.ensure(settings.font_size)
+            key = (get_view_key(view), settings.font_size,
+                   settings.box_color, settings.text_color,
+                   settings.kind_colors)
+            rec.hit("layer", IVRenderer.__layers.draw(
+                region, key, layout, IVRenderer.draw, settings, layout))
+        else:
+            IVRenderer.draw(settings, layout)
+        cache.drawn = layout
+        rec.lap("draw")
+        rec.end()
+
+        if task is not None and not task.done:
+            draw_progress(region, task.progress)
+
+        if IVRenderer.profiler.enabled and context.scene.iv_profile_hud:
+            IVRenderer.profiler.draw_hud(region)
 
     @staticmethod
     def is_valid_context(context):
@@ -243,16 +2675,35 @@ class IVOperator(bpy.types.Operator):
     bl_description = "Index Visualizer"
     bl_options = {"REGISTER", "UNDO"}
 
+    def modal(self, context, event):
+        if not IVRenderer.is_running():
+            return {"FINISHED"}
+        if event.type == 'MOUSEMOVE':
+            IVRenderer.track_mouse(context, event)
+        elif event.type == 'TIMER':
+            IVRenderer.settle(context)
+        return {"PASS_THROUGH"}
+
     def invoke(self, context, event):
-        if context.area.type == "VIEW_3D":
+        # indices are toggled in each area
+        area = context.area
+        if area.type == "VIEW_3D":
+            ret = {"FINISHED"}
             if IVRenderer.is_running() is False:
                 IVRenderer.handle_add(self, context)
+                IVRenderer.enable_area(area)
+                # track mouse for near cursor mode and view changes for
+                # adaptive mode
+                context.window_manager.modal_handler_add(self)
+                ret = {"RUNNING_MODAL"}
+            elif not IVRenderer.is_enabled(area):
+                IVRenderer.enable_area(area)
             else:
-                IVRenderer.handle_remove(self, context)
-            for area in context.screen.areas:
-                if area.type == context.area.type:
-                    area.tag_redraw()
-            return {"FINISHED"}
+                IVRenderer.disable_area(area)
+                if not IVRenderer.has_areas():
+                    IVRenderer.handle_remove(self, context)
+            area.tag_redraw()
+            return ret
         else:
             return {"CANCELLED"}
 
@@ -264,6 +2715,10 @@ class IVOperator(bpy.types.Operator):
     def is_running(self):
         return IVRenderer.is_running()
 
+    @classmethod
+    def is_enabled(self, area):
+        return IVRenderer.is_running() and IVRenderer.is_enabled(area)
+
     @staticmethod
     def is_valid_context(context):
         return IVRenderer.is_valid_context(context)
@@ -276,6 +2731,19 @@ class RenderUVIndex(bpy.types.Operator):
     bl_description = "Render UV Index"
 
     __handle = None
+    __boxes = QuadBatch()
+    __glyphs = GlyphAtlas()
+    __bmesh = SnapshotCache()
+    __labels = SnapshotCache()
+    __buffer = LabelBuffer(dim=2, oriented=True)
+
+    __layers = LayerCache()
+    # region -> ProgressiveTask
+    __tasks = {}
+    # areas where indices are rendered
+    __areas = set()
+
+    profiler = FrameProfiler("uv")
 
     @classmethod
     def __handle_add(cls, context):
@@ -283,6 +2751,8 @@ class RenderUVIndex(bpy.types.Operator):
             sie = bpy.types.SpaceImageEditor
             cls.__handle = sie.draw_handler_add(
                 cls.__render, (context,), 'WINDOW','POST_PIXEL')
+        if cls.__on_scene_update not in bpy.app.handlers.scene_update_post:
+            bpy.app.handlers.scene_update_post.append(cls.__on_scene_update)
 
     @classmethod
     def __handle_remove(cls):
@@ -290,6 +2760,21 @@ class RenderUVIndex(bpy.types.Operator):
             sie = bpy.types.SpaceImageEditor
             sie.draw_handler_remove(cls.__handle, 'WINDOW')
             cls.__handle = None
+        if cls.__on_scene_update in bpy.app.handlers.scene_update_post:
+            bpy.app.handlers.scene_update_post.remove(cls.__on_scene_update)
+        cls.__bmesh.update(None, None)
+        cls.__labels.invalidate()
+        cls.__layers.free()
+        cls.__glyphs.free()
+        cls.__tasks = {}
+        cls.__areas.clear()
+
+    @staticmethod
+    def __on_scene_update(scene):
+        # UVs and mesh data are tagged as updated when they are edited
+        obj = scene.objects.active
+        if (obj is not None) and (obj.is_updated or obj.is_updated_data):
+            RenderUVIndex.__labels.invalidate()
 
     @classmethod
     def release_handle(cls):
@@ -299,6 +2784,10 @@ class RenderUVIndex(bpy.types.Operator):
     def is_running(cls):
         return cls.__handle is not None
 
+    @classmethod
+    def is_enabled(cls, area):
+        return cls.is_running() and area.as_pointer() in cls.__areas
+
     @staticmethod
     def is_valid_context(context):
         obj = context.object
@@ -318,14 +2807,163 @@ class RenderUVIndex(bpy.types.Operator):
         return True
 
     @staticmethod
-    def __render_text(size, v, s):
-        blf.size(0, size, 72)
-        blf.position(0, v.x, v.y, 0)
-        blf.draw(0, s)
+    def collect(context, obj, bm, uv_layer, out=None):
+        """Collect UV labels to be rendered, in UV space, into LabelBuffer
+        out if given, together with the grid of faces they belong to."""
+        scene = context.scene
+        ruvi_props = scene.ruvi_properties
+        uv_select_sync = scene.tool_settings.use_uv_select_sync
+
+        arrays = read_mesh_arrays(obj, bm)
+        uv, uv_sel = read_uv_arrays(obj, bm, uv_layer)
+        loop_next = get_next_loops(arrays)
+        loop_face = np.repeat(np.arange(len(arrays.face_loop_total)),
+                              arrays.face_loop_total)
+        loop_vert_sel = arrays.vert_sel[arrays.loop_verts]
+
+        face_shown = arrays.face_sel | uv_select_sync
+        loop_shown = face_shown[loop_face] & (uv_sel | uv_select_sync)
+        # in sync mode, loops whose vert is not selected are skipped
+        if ruvi_props.verts and uv_select_sync:
+            loop_rest = loop_shown & loop_vert_sel
+        else:
+            loop_rest = loop_shown
+        mid, tangents, normals = get_uv_loop_geometry(uv, loop_next)
+
+        labels = []
+        if ruvi_props.verts:
+            loops = np.flatnonzero(loop_rest)
+            labels.append((arrays.loop_verts[loops], uv[loops], None, None,
+                           LABEL_VERT, loop_face[loops]))
+        if ruvi_props.edges:
+            if uv_select_sync:
+                next_sel = loop_vert_sel[loop_next] & \
+                    arrays.edge_sel[arrays.loop_edges]
+            else:
+                next_sel = uv_sel[loop_next]
+            loops = np.flatnonzero(loop_rest & next_sel)
+            labels.append((arrays.loop_edges[loops], mid[loops],
+                           tangents[loops], normals[loops], LABEL_EDGE,
+                           loop_face[loops]))
+        if ruvi_props.loops and not uv_select_sync:
+            loops = np.flatnonzero(loop_rest)
+            labels.append((loops, mid[loops], tangents[loops],
+                           normals[loops], LABEL_LOOP, loop_face[loops]))
+        if ruvi_props.faces:
+            if uv_select_sync:
+                face_rendered = arrays.face_sel
+            else:
+                selected_loops_count = np.bincount(
+                    loop_face, weights=loop_shown,
+                    minlength=len(arrays.face_sel))
+                face_rendered = face_shown & (selected_loops_count > 0)
+            faces = np.flatnonzero(face_rendered)
+            if len(faces) > 0:
+                uvc = get_uv_face_centroids(arrays, uv)
+                labels.append((faces, uvc[faces], None, None, LABEL_FACE,
+                               faces))
+
+        if out is None:
+            out = LabelBuffer(dim=2, oriented=True)
+        out.resize(sum(len(label[0]) for label in labels))
+        offset = 0
+        for idx, pos, tan, nor, kind, _ in labels:
+            out.fill(idx, pos, kind, tan, nor, offset)
+            offset += len(idx)
+        label_faces = np.concatenate(
+            [label[5] for label in labels] + [np.empty(0, dtype=np.int64)])
+        return UVLabelData(out, UVFaceGrid(arrays, uv, label_faces))
+
+    @staticmethod
+    def cull(context, region, data):
+        """Get labels of faces overlapping the region. Margin of a label
+        size is kept so that labels sticking into the region are drawn."""
+        w, h = GlyphAtlas.get_text_dimensions(
+            context.scene.ruvi_properties.font_size, 8)
+        scale, offset = get_view2d_transform(region.view2d)
+        lo = (np.array([-w - h, -w - h]) - offset) / scale
+        hi = (np.array([region.width + w + h, region.height + w + h]) -
+              offset) / scale
+        visible = data.faces.query(np.minimum(lo, hi), np.maximum(lo, hi))
+        if visible is None:
+            return data.labels
+        return data.labels.select(visible)
+
+    @staticmethod
+    def dedup(region, labels):
+        """Merge vert and edge labels which are labeled once per loop at the
+        same place. Loops of split UV seams are apart on screen, so they are
+        kept separately."""
+        # loop and face labels are unique
+        shared = np.flatnonzero((labels.kinds == LABEL_VERT) |
+                                (labels.kinds == LABEL_EDGE))
+        scale, offset = get_view2d_transform(region.view2d)
+        keep = get_unique_labels(labels.indices[shared],
+                                 labels.kinds[shared],
+                                 labels.positions[shared] * scale + offset,
+                                 UV_MERGE_PIXELS)
+        if keep.all():
+            return labels
+        mask = np.ones(len(labels), dtype=bool)
+        mask[shared[~keep]] = False
+        return labels.select(mask)
+
+    @staticmethod
+    def layout(context, region, labels):
+        """Place UV labels on region."""
+        ruvi_props = context.scene.ruvi_properties
+        font_size = ruvi_props.font_size
+
+        scale, offset = get_view2d_transform(region.view2d)
+        positions = labels.screen
+        np.multiply(labels.positions, scale, out=positions)
+        positions += offset
+
+        ch_counts = get_digit_counts(labels.indices)
+        widths = np.zeros(len(ch_counts), dtype=np.float32)
+        heights = np.zeros(len(ch_counts), dtype=np.float32)
+        for c in np.unique(ch_counts).tolist():
+            w, h = GlyphAtlas.get_text_dimensions(font_size, c)
+            widths[ch_counts == c] = w
+            heights[ch_counts == c] = h
+
+        # loop index is shifted so that it is not overlapped with edge index
+        loop_offset = 1.5 if ruvi_props.edges else 1.0
+        sub_offsets = np.where(labels.kinds == LABEL_LOOP, loop_offset, 0.0)
+
+        origins, angles = place_uv_labels(positions, labels.tangents,
+                                          labels.normals, widths, heights,
+                                          sub_offsets)
+        return UVLayoutData(labels.indices, origins, angles, widths, heights,
+                            ch_counts, labels.kinds)
+
+    @classmethod
+    def draw(cls, context, layout):
+        """Render all boxes at once, and then indices on them."""
+        quasi_black = (0.0, 0.0, 0.0, 0.3)
+        boxed = (layout.kinds == LABEL_VERT) | (layout.kinds == LABEL_EDGE)
+        cls.__boxes.clear()
+        cls.__boxes.add(get_rotated_box_quads(layout.origins[boxed],
+                                              layout.widths[boxed],
+                                              layout.heights[boxed],
+                                              layout.ch_counts[boxed],
+                                              layout.angles[boxed]),
+                        quasi_black)
+        cls.__boxes.draw()
+
+        # render indices with glyph atlas if possible
+        font_size = context.scene.ruvi_properties.font_size
+        glyphs = cls.__glyphs
+        if GlyphAtlas.is_supported() and glyphs.ensure(font_size):
+            cls.__draw_glyphs(glyphs, layout)
+        else:
+            cls.__render_texts(font_size, layout.indices, layout.origins,
+                               layout.angles, layout.kinds)
 
     @classmethod
     def __render(cls, context):
-        if not cls.is_valid_context(context):
+        if not cls.is_valid_context(context) or \
+                not cls.is_enabled(context.area):
             return
 
         for region in context.area.regions:
@@ -336,191 +2974,202 @@ class RenderUVIndex(bpy.types.Operator):
 
         scene = context.scene
         ruvi_props = scene.ruvi_properties
-        uv_select_sync = scene.tool_settings.use_uv_select_sync
-        black = (0.0, 0.0, 0.0, 1.0)
-        quasi_black = (0.0, 0.0, 0.0, 0.3)
-        blf.shadow(0, 3, 1.0, 0.0, 0.0, 1.0)
-        blf.shadow_offset(0, 2, -2)
 
+        cls.profiler.set_enabled(scene.iv_profile)
+        rec = cls.profiler.begin()
         [me, bm, uv_layer] = cls.__init_bmesh(context)
 
-        for f in bm.faces:
-            if not f.select and not uv_select_sync:
-                continue
+        # re-collect only when mesh, UV, selection or settings are changed
+        obj = context.active_object
+        signature = (get_change_signature(context, obj, bm),
+                     scene.tool_settings.use_uv_select_sync,
+                     ruvi_props.verts, ruvi_props.edges,
+                     ruvi_props.faces, ruvi_props.loops)
+        rec.hit("collect", cls.__labels.is_valid(signature))
+        if not cls.__labels.is_valid(signature):
+            cls.__labels.update(signature,
+                                cls.collect(context, obj, bm, uv_layer,
+                                            cls.__buffer))
+        rec.lap("collect")
+        rec.count("collected", len(cls.__labels.data.labels))
+
+        # re-render labels only when labels, view or font size is changed
+        if scene.iv_cache_layer and LayerCache.is_supported():
+            scale, offset = get_view2d_transform(region.view2d)
+            key = (cls.__labels.version, tuple(scale.tolist()),
+                   tuple(offset.tolist()), ruvi_props.font_size,
+                   region.width, region.height)
+            task = cls.__tasks.get(region.as_pointer())
+            if scene.iv_progressive and (task is None or task.key != key):
+                task = cls.__tasks[region.as_pointer()] = ProgressiveTask(
+                    key, cls.__iter_draw_labels(
+                        context, region,
+                        cls.dedup(region, cls.cull(context, region,
+                                                   cls.__labels.data))),
+                    PROGRESSIVE_UV_CHUNK)
+            if scene.iv_progressive and not task.done:
+                # render labels into the layer chunk by chunk over redraws
+                cls.__layers.append(region, key, task.run,
+                                    scene.iv_time_budget / 1000.0)
+                rec.lap("draw")
+                context.area.tag_redraw()
+                draw_progress(region, task.progress)
+            else:
+                rec.hit("layer", cls.__layers.draw(
+                    region, key, None, cls.__draw_labels, context, region,
+                    rec))
+                rec.lap("composite")
+        else:
+            cls.__draw_labels(context, region, rec)
+        rec.end()
+
+        if cls.profiler.enabled and scene.iv_profile_hud:
+            cls.profiler.draw_hud(region)
+
+    @classmethod
+    def __draw_labels(cls, context, region, rec):
+        rec.mark()
+        labels = cls.cull(context, region, cls.__labels.data)
+        rec.lap("cull")
+        labels = cls.dedup(region, labels)
+        rec.lap("dedup")
+        rec.count("visible", len(labels))
+
+        layout = cls.layout(context, region, labels)
+        rec.lap("layout")
+        rec.count("drawn", len(layout.indices))
+
+        cls.draw(context, layout)
+        rec.lap("draw")
+
+    @classmethod
+    def __iter_draw_labels(cls, context, region, labels,
+                           chunk=PROGRESSIVE_UV_CHUNK):
+        """Lay out and render labels chunk by chunk, yielding progress."""
+        n = len(labels.indices)
+        start = 0
+        while start < n:
+            part = labels.select(slice(start, start + chunk))
+            start += len(part)
+            cls.draw(context, cls.layout(context, region, part))
+            chunk = (yield (start / n, None)) or chunk
+
+    @staticmethod
+    def __draw_glyphs(glyphs, layout):
+        """Draw shadows of loop indices, and then all indices on them in
+        one draw call. Edge and loop indices are rotated along edges."""
+        rotated = (layout.kinds == LABEL_EDGE) | (layout.kinds == LABEL_LOOP)
+        angles = np.where(rotated, layout.angles, 0.0)
+
+        # shadow is offset in rotated text space, but not blurred
+        loops = np.flatnonzero(layout.kinds == LABEL_LOOP)
+        if len(loops) > 0:
+            dx, dy = UV_SHADOW_OFFSET
+            cos = np.cos(angles[loops])
+            sin = np.sin(angles[loops])
+            offsets = np.stack([cos * dx - sin * dy, sin * dx + cos * dy],
+                               axis=1)
+            glyphs.draw(layout.indices[loops],
+                        layout.origins[loops] + offsets, UV_SHADOW_COLOR,
+                        angles=angles[loops])
+        glyphs.draw(layout.indices, layout.origins, (1.0, 1.0, 1.0, 1.0),
+                    angles=angles)
 
-            selected_loops_count = 0
-            uvc = Vector([0.0, 0.0])    # center uv of the face
-
-            for loop1 in f.loops:
-                uv1 = loop1[uv_layer].uv
-                uvc += uv1
-                if not loop1[uv_layer].select and not uv_select_sync:
-                    continue
-                selected_loops_count += 1
-
-                # Draw Vert index
-                if ruvi_props.verts:
-                    if uv_select_sync and not loop1.vert.select:
-                        continue
-                    cls.__render_text_index(context, region, loop1.vert.index,
-                                            uv1, bg_color=quasi_black)
-
-                # Get next loop parameter
-                loop2, *arg = cls.__get_2nd_loop(loop1, uv_layer)
-                if loop2 is None:
-                    continue
-                uv2, uvm, uvt, uvn = arg
-
-                # Draw Edge index
-                blf.enable(0, blf.ROTATION)
-                if ruvi_props.edges:
-                    if (not uv_select_sync and loop2[uv_layer].select) or \
-                       (uv_select_sync and loop2.vert.select
-                            and loop1.edge.select):
-                        cls.__render_text_index(context,region,
-                                                loop1.edge.index,
-                                                uvm, uvt=uvt, uvn=uvn,
-                                                bg_color=quasi_black)
-
-                # Draw Loop index
-                blf.enable(0, blf.SHADOW)
-                if ruvi_props.loops and not uv_select_sync:
-                    cls.__render_text_index(context, region, loop1.index,
-                                            uvm, uvt=uvt, uvn=uvn,
-                                            loop_offset=(1.0, 1.5))
-
-                blf.disable(0, blf.ROTATION)
-                blf.disable(0, blf.SHADOW)
-
-            # Draw Face index
-            if ruvi_props.faces and \
-                ((not uv_select_sync and selected_loops_count) or \
-                 (uv_select_sync and f.select)):
-                cls.__render_text_index(
-                                context,
-                                region,
-                                f.index,
-                                uvc/len(f.loops),
-                                )
+    @staticmethod
+    def __render_texts(size, indices, origins, angles, kinds):
+        blf.size(0, size, 72)
+        blf.shadow(0, 3, *UV_SHADOW_COLOR)
+        blf.shadow_offset(0, *UV_SHADOW_OFFSET)
+        rotation = shadow = False
+        blf.disable(0, blf.ROTATION)
+        blf.disable(0, blf.SHADOW)
+        for index, (x, y), angle, kind in zip(indices.tolist(),
+                                              origins.tolist(),
+                                              angles.tolist(),
+                                              kinds.tolist()):
+            rot = kind in (LABEL_EDGE, LABEL_LOOP)
+            sdw = kind == LABEL_LOOP
+            if rot != rotation:
+                rotation = rot
+                (blf.enable if rot else blf.disable)(0, blf.ROTATION)
+            if sdw != shadow:
+                shadow = sdw
+                (blf.enable if sdw else blf.disable)(0, blf.SHADOW)
+            blf.rotation(0, angle)
+            blf.position(0, x, y, 0)
+            blf.draw(0, str(index))
+        blf.disable(0, blf.ROTATION)
+        blf.disable(0, blf.SHADOW)
 
     def invoke(self, context, event):
-        scene = context.scene
-        if context.area.type == 'IMAGE_EDITOR':
+        # indices are toggled in each area
+        area = context.area
+        if area.type == 'IMAGE_EDITOR':
             if not self.is_running():
                 self.__handle_add(context)
+            if area.as_pointer() not in self.__areas:
+                self.__areas.add(area.as_pointer())
             else:
-                self.__handle_remove()
-
-            # Redraw all UV/Image Editor Views
-            for a in context.screen.areas:
-                if a.type == context.area.type: # the filtering is necessary
-                    a.tag_redraw()
+                self.__areas.discard(area.as_pointer())
+                for region in area.regions:
+                    self.__tasks.pop(region.as_pointer(), None)
+                    self.__layers.discard(region)
+                if not self.__areas:
+                    self.__handle_remove()
+            area.tag_redraw()
 
             return {'FINISHED'}
         else:
             return {'CANCELLED'}
 
-    @staticmethod
-    def __get_2nd_loop(loop1, uv_layer):
-        loop2 = loop1.link_loop_next
-        if (loop2 is None) or (loop1 == loop2):
-            return None
+    @classmethod
+    def __init_bmesh(cls, context):
+        me = context.active_object.data
 
-        uv1 = loop1[uv_layer].uv
-        uv2 = loop2[uv_layer].uv
+        # reuse bmesh and UV layer while edit mesh and its UV layers are alive
+        cache = cls.__bmesh
+        if cache.data is not None:
+            bm = cache.data[1]
+            if bm.is_valid and \
+               cache.is_valid((me.as_pointer(), len(bm.loops.layers.uv))):
+                return cache.data
 
-        # middle vector between uv1 and uv2
-        uvm = (uv1 + uv2) / 2.0
-        # unit tangent vector from  uv1 to uv2
-        uvt = uv2 - uv1
-        if uvt.length != 0.0:
-            uvt = uvt / uvt.length
-        else:
-            uvt.x, uvt.y = 1.0, 0.0
-        # unit normal vector of uvt
-        uvn = Vector([-uvt.y, uvt.x])
+        bm = bmesh.from_edit_mesh(me)
+        uv_layer = bm.loops.layers.uv.verify()
+        bm.faces.layers.tex.verify()  # currently blender needs both layers.
+        cache.update((me.as_pointer(), len(bm.loops.layers.uv)),
+                     (me, bm, uv_layer))
+        cls.__labels.invalidate()
 
-        return (loop2, uv2, uvm, uvt, uvn)
+        return cache.data
 
-    # uv: uv vector to text position
-    # uvt: tangent unit vector on uv
-    # uvn: normal unit vector on uv
-    # loop_offset: additional offset to loop text pos
-    @classmethod
-    def __render_text_index(cls, context, region, index, uv,
-                            uvt=Vector([1.0, 0.0]), uvn=Vector([0.0, 1.0]),
-                            loop_offset=(0.0, 0.0), bg_color=None):
-        text = str(index)
-        ruvi_props = scene = context.scene.ruvi_properties
-        additional_offset = loop_offset[ruvi_props.edges]
-
-        # Calcurate position and angle
-        v = Vector(region.view2d.view_to_region(uv.x, uv.y))
-        text_w, text_h = blf.dimensions(0, text)
-
-        offset = (text_w * uvt + text_h * uvn) / 2
-        sub_offset = additional_offset * text_h * uvn
-
-        vxo = Vector([1, 0])
-        vxy = Vector([1,-1])
-        angle = uvt.angle_signed(vxo)
-        if uvt.angle_signed(vxy) > 0:
-            v = v - offset + sub_offset
-        else:
-            v = v + offset + sub_offset
-            angle -= pi
 
-        blf.rotation(0, angle)
+class IVExportStats(bpy.types.Operator):
+    """Export profiling statistics of the overlays to CSV or JSON file"""
 
-        # Render index
-        if bg_color is not None:
-            cls.__draw_background(bg_color, text, v, angle)
-        font_size = ruvi_props.font_size
-        cls.__render_text(font_size, v, text)
+    bl_idname = "view3d.iv_export_stats"
+    bl_label = "Export Statistics"
 
-    @staticmethod
-    def __draw_background(color, text, vo, angle=0.0):
-        text_w, text_h = blf.dimensions(0, text)
-        font_w = text_w / len(text)
+    filepath = StringProperty(subtype="FILE_PATH")
+    filter_glob = StringProperty(default="*.csv;*.json", options={'HIDDEN'})
 
-        a = 0.6
-        x1 = vo.x  - font_w / 2
-        y1 = vo.y  - text_h / 2 * a
-        x2 = x1 + text_w + font_w
-        y2 = y1 + text_h * (1 + a)
+    def execute(self, context):
+        export_stats(bpy.path.abspath(self.filepath),
+                     [IVRenderer.profiler, RenderUVIndex.profiler])
+        self.report({'INFO'}, "Exported to {}".format(self.filepath))
+        return {'FINISHED'}
 
-        poss = [
-                Vector([x1, y1]),
-                Vector([x1, y2]),
-                Vector([x2, y2]),
-                Vector([x2, y1])
-            ]
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = "index_visualizer_stats.csv"
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
 
-        if angle != 0.0:
-            rot = Matrix.Rotation(angle, 2, 'Z')
-            for i in range(len(poss)):
-                poss[i] = rot * (poss[i] - vo) + vo
 
-        # render box
-        bgl.glEnable(bgl.GL_BLEND)
-        bgl.glBegin(bgl.GL_QUADS)
-        bgl.glColor4f(*color)
-        for v in poss:
-            bgl.glVertex2f(v.x, v.y)
-        bgl.glEnd()
-        bgl.glColor4f(1.0, 1.0, 1.0, 1.0)
-
-    @staticmethod
-    def __init_bmesh(context):
-        me = context.active_object.data
-        bm = bmesh.from_edit_mesh(me)
-        uv_layer = bm.loops.layers.uv.verify()
-        bm.faces.layers.tex.verify()  # currently blender needs both layers.
-        bm.faces.ensure_lookup_table()
-        bm.verts.ensure_lookup_table()
-        bm.edges.ensure_lookup_table()
-
-        return (me, bm, uv_layer)
+def update_profile(self, context):
+    # records are cleared at once, even if overlays are not drawn
+    for profiler in (IVRenderer.profiler, RenderUVIndex.profiler):
+        profiler.set_enabled(context.scene.iv_profile)
 
 
 # UI View
@@ -532,7 +3181,7 @@ class OBJECT_PT_IV(bpy.types.Panel):
     def draw(self, context):
         sc = context.scene
         layout = self.layout
-        if not IVOperator.is_running():
+        if not IVOperator.is_enabled(context.area):
             layout.operator(IVOperator.bl_idname, text="Start", icon="PLAY")
         else:
             layout.operator(IVOperator.bl_idname, text="Stop", icon="PAUSE")
@@ -540,6 +3189,35 @@ class OBJECT_PT_IV(bpy.types.Panel):
             layout.prop(sc, "iv_text_color")
             layout.label(text="Size:")
             layout.prop(sc, "iv_font_size", text="Text")
+            layout.prop(sc, "iv_all_kinds")
+            if sc.iv_all_kinds:
+                layout.prop(sc, "iv_vert_color")
+                layout.prop(sc, "iv_edge_color")
+                layout.prop(sc, "iv_face_color")
+            layout.prop(sc, "iv_hide_overlapped")
+            layout.prop(sc, "iv_visible_only")
+            layout.prop(sc, "iv_max_labels")
+            layout.prop(sc, "iv_use_worker")
+            layout.prop(sc, "iv_cache_layer")
+            layout.prop(sc, "iv_progressive")
+            if sc.iv_progressive:
+                layout.prop(sc, "iv_time_budget")
+            layout.prop(sc, "iv_lod")
+            layout.prop(sc, "iv_adaptive")
+            if sc.iv_adaptive:
+                layout.prop(sc, "iv_nav_labels")
+                layout.prop(sc, "iv_settle_time")
+        layout.prop(sc, "iv_near_cursor")
+        if sc.iv_near_cursor:
+            layout.prop(sc, "iv_near_source", text="")
+            if sc.iv_near_source == 'CURSOR':
+                layout.prop(sc, "iv_near_radius")
+            else:
+                layout.prop(sc, "iv_near_pixels")
+        layout.prop(sc, "iv_profile")
+        if sc.iv_profile:
+            layout.prop(sc, "iv_profile_hud")
+            layout.operator(IVExportStats.bl_idname, icon="FILE_TEXT")
 
     @classmethod
     def poll(cls, context):
@@ -557,7 +3235,7 @@ class IMAGE_PT_RUVI(bpy.types.Panel):
         ruvi_props = scene.ruvi_properties
         layout = self.layout
 
-        if not RenderUVIndex.is_running():
+        if not RenderUVIndex.is_enabled(context.area):
             layout.operator(RenderUVIndex.bl_idname, text="Start", icon="PLAY")
         else:
             layout.operator(RenderUVIndex.bl_idname, text="Stop", icon="PAUSE")
@@ -616,6 +3294,39 @@ def init_properties():
         subtype="COLOR",
         size=4
     )
+    sc.iv_all_kinds = BoolProperty(
+        name="All Kinds",
+        description="Render indices of selected verts, edges and faces "
+                    "together regardless of select mode",
+        default=False
+    )
+    sc.iv_vert_color = FloatVectorProperty(
+        name="Vertex Color",
+        description="Text color of vertex indices",
+        default=(1.0, 1.0, 1.0, 1.0),
+        min=0.0,
+        max=1.0,
+        subtype="COLOR",
+        size=4
+    )
+    sc.iv_edge_color = FloatVectorProperty(
+        name="Edge Color",
+        description="Text color of edge indices",
+        default=(1.0, 0.8, 0.3, 1.0),
+        min=0.0,
+        max=1.0,
+        subtype="COLOR",
+        size=4
+    )
+    sc.iv_face_color = FloatVectorProperty(
+        name="Face Color",
+        description="Text color of face indices",
+        default=(0.4, 0.8, 1.0, 1.0),
+        min=0.0,
+        max=1.0,
+        subtype="COLOR",
+        size=4
+    )
     sc.iv_font_size = IntProperty(
         name="Text Size",
         description="Text size",
@@ -623,6 +3334,115 @@ def init_properties():
         min=10,
         max=100
     )
+    sc.iv_hide_overlapped = BoolProperty(
+        name="Hide Overlapped",
+        description="Hide indices overlapping other indices",
+        default=True
+    )
+    sc.iv_visible_only = BoolProperty(
+        name="Visible Only",
+        description="Hide indices occluded by geometry",
+        default=False
+    )
+    sc.iv_max_labels = IntProperty(
+        name="Max Indices",
+        description="Maximum number of indices rendered at once",
+        default=2000,
+        min=1,
+        max=100000
+    )
+    sc.iv_use_worker = BoolProperty(
+        name="Background Preparation",
+        description="Prepare indices on worker thread to keep UI responsive",
+        default=True
+    )
+    sc.iv_lod = BoolProperty(
+        name="Cluster When Zoomed Out",
+        description="Render clusters of close labels as index range",
+        default=False
+    )
+    sc.iv_cache_layer = BoolProperty(
+        name="Cache Rendered Labels",
+        description="Keep rendered labels in offscreen buffer and reuse "
+                    "them while labels and view are not changed",
+        default=True
+    )
+    sc.iv_progressive = BoolProperty(
+        name="Progressive",
+        description="Render labels chunk by chunk over redraws, so that "
+                    "huge selection does not freeze UI",
+        default=False
+    )
+    sc.iv_time_budget = FloatProperty(
+        name="Time Budget (ms)",
+        description="Time spent for labels per redraw in progressive mode",
+        default=4.0,
+        min=0.5,
+        max=100.0
+    )
+    sc.iv_adaptive = BoolProperty(
+        name="Throttle While Navigating",
+        description="Render only labels near the center while view is "
+                    "being changed",
+        default=False
+    )
+    sc.iv_nav_labels = IntProperty(
+        name="Labels While Navigating",
+        description="Max number of labels rendered while view is being "
+                    "changed",
+        default=200,
+        min=0,
+        max=100000
+    )
+    sc.iv_settle_time = FloatProperty(
+        name="Settle Time",
+        description="Seconds view must be still before all labels are "
+                    "laid out",
+        default=0.2,
+        min=0.0,
+        max=5.0,
+        subtype='TIME'
+    )
+    sc.iv_near_cursor = BoolProperty(
+        name="Near Cursor",
+        description="Render indices of all elements near the cursor, "
+                    "including unselected ones",
+        default=False
+    )
+    sc.iv_near_source = EnumProperty(
+        name="Cursor",
+        description="Cursor around which indices are rendered",
+        items=[
+            ('MOUSE', "Mouse", "Elements near mouse cursor on screen"),
+            ('CURSOR', "3D Cursor", "Elements near 3D cursor")
+        ],
+        default='MOUSE'
+    )
+    sc.iv_near_radius = FloatProperty(
+        name="Radius",
+        description="Distance from 3D cursor",
+        default=1.0,
+        min=0.0,
+        subtype='DISTANCE'
+    )
+    sc.iv_near_pixels = IntProperty(
+        name="Radius",
+        description="Distance from mouse cursor in pixels",
+        default=100,
+        min=1,
+        max=2000
+    )
+    sc.iv_profile = BoolProperty(
+        name="Profile",
+        description="Record per-frame statistics of the overlays",
+        default=False,
+        update=update_profile
+    )
+    sc.iv_profile_hud = BoolProperty(
+        name="Show Statistics",
+        description="Show statistics at the corner of the region",
+        default=True
+    )
     sc.ruvi_properties = bpy.props.PointerProperty(
         type=RenderUVIndexProperties
     )
@@ -630,7 +3450,28 @@ def init_properties():
 
 def clear_properties():
     sc = bpy.types.Scene
+    del sc.iv_profile_hud
+    del sc.iv_profile
+    del sc.iv_near_pixels
+    del sc.iv_near_radius
+    del sc.iv_near_source
+    del sc.iv_near_cursor
+    del sc.iv_lod
+    del sc.iv_settle_time
+    del sc.iv_nav_labels
+    del sc.iv_adaptive
+    del sc.iv_cache_layer
+    del sc.iv_time_budget
+    del sc.iv_progressive
+    del sc.iv_use_worker
+    del sc.iv_max_labels
+    del sc.iv_visible_only
+    del sc.iv_hide_overlapped
     del sc.iv_font_size
+    del sc.iv_face_color
+    del sc.iv_edge_color
+    del sc.iv_vert_color
+    del sc.iv_all_kinds
     del sc.iv_text_color
     del sc.iv_box_color
     del sc.ruvi_properties
@@ -656,6 +3497,7 @@ def register():
 
 def unregister():
     bpy.types.VIEW3D_OT_iv_op.release_handle(bpy.context)
+    RenderUVIndex.release_handle()
 
     remove_keymap_item("Blender Addon", "3D View", IVOperator.bl_idname)
     remove_keymap_item("Blender Addon", "UV Editor", RenderUVIndex.bl_idname)